@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import os
+import time
+from functools import wraps
+
+# upper bounds of the latency histogram buckets in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+DEFAULT_METRICS_INTERVAL_SECONDS = 300
+
+_registry = {}
+
+def get_metrics(app_name):
+    if app_name not in _registry:
+        _registry[app_name] = Metrics(app_name)
+    return _registry[app_name]
+
+def is_debug(hass):
+    logger = getattr(hass, "logger", None)
+    return logger is None or logger.isEnabledFor(logging.DEBUG)
+
+def log_debug(hass, msg, *args):
+    # formats only when DEBUG is enabled for the app
+    if is_debug(hass):
+        hass.log(msg.format(*args), level="DEBUG")
+
+def timed(name=None):
+    # counts and times a callback, on apps directly or on objects holding the app as `hass`.
+    # coroutine functions stay coroutine functions, AppDaemon decides by that where to run them
+    def decorator(f):
+        key = name or f.__qualname__
+        if asyncio.iscoroutinefunction(f):
+            @wraps(f)
+            async def async_wrapper(self, *args, **kwargs):
+                metrics = self.metrics if hasattr(self, "metrics") else self.hass.metrics
+                start = time.perf_counter()
+                try:
+                    return await f(self, *args, **kwargs)
+                finally:
+                    metrics.observe(key, time.perf_counter() - start)
+            return async_wrapper
+
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics if hasattr(self, "metrics") else self.hass.metrics
+            start = time.perf_counter()
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                metrics.observe(key, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        i = 0
+        while i < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= rank:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max
+        return self.max
+
+class Metrics:
+    def __init__(self, app_name):
+        self.app_name = app_name
+        self.counters = {}
+        self.histograms = {}
+        # the last summary written to HA
+        self.published = None
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.observe(seconds * 1000.)
+
+    def summary(self):
+        callbacks = {}
+        for name, h in self.histograms.items():
+            callbacks[name] = {
+                "count": h.count,
+                "mean_ms": round(h.sum / h.count, 3) if h.count else 0,
+                "p95_ms": h.quantile(0.95),
+                "max_ms": round(h.max, 3),
+            }
+        return {"counters": dict(self.counters), "callbacks": callbacks}
+
+    def render_prometheus(self):
+        lines = []
+        app = self.app_name
+        for name, value in sorted(self.counters.items()):
+            lines.append("# TYPE appdaemon_app_{}_total counter".format(name))
+            lines.append('appdaemon_app_{}_total{{app="{}"}} {}'.format(name, app, value))
+        if len(self.histograms) > 0:
+            lines.append("# TYPE appdaemon_callback_latency_ms histogram")
+        for name, h in sorted(self.histograms.items()):
+            labels = 'app="{}",callback="{}"'.format(app, name)
+            cumulative = 0
+            for bound, c in zip(LATENCY_BUCKETS_MS, h.counts):
+                cumulative += c
+                lines.append('appdaemon_callback_latency_ms_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('appdaemon_callback_latency_ms_bucket{{{},le="+Inf"}} {}'.format(labels, h.count))
+            lines.append("appdaemon_callback_latency_ms_sum{{{}}} {}".format(labels, round(h.sum, 3)))
+            lines.append("appdaemon_callback_latency_ms_count{{{}}} {}".format(labels, h.count))
+        return "\n".join(lines) + "\n"
+
+class MetricsMixin:
+    # mixed into hass.Hass apps, counts HA round trips and publishes the app's metrics
+
+    @property
+    def metrics(self):
+        return get_metrics(self.name)
+
+    def get_state(self, *args, **kwargs):
+        self.metrics.inc("ha_get_state")
+        return super().get_state(*args, **kwargs)
+
+    def get_history(self, *args, **kwargs):
+        self.metrics.inc("ha_get_history")
+        return super().get_history(*args, **kwargs)
+
+    def call_service(self, *args, **kwargs):
+        self.metrics.inc("ha_call_service")
+        return super().call_service(*args, **kwargs)
+
+    def set_state(self, *args, **kwargs):
+        self.metrics.inc("ha_set_state")
+        return super().set_state(*args, **kwargs)
+
+    def start_metrics(self):
+        interval = self.args.get("metrics_interval_seconds", DEFAULT_METRICS_INTERVAL_SECONDS)
+        if interval:
+            self.run_every(self.publish_metrics, "now+{}".format(interval), interval)
+
+    def publish_metrics(self, kwargs):
+        summary = self.metrics.summary()
+        if summary == self.metrics.published:
+            return
+        self.metrics.published = summary
+        super().set_state(
+            "sensor.{}_metrics".format(self.name),
+            state=sum(x["count"] for x in summary["callbacks"].values()),
+            counters=summary["counters"],
+            callbacks=summary["callbacks"]
+        )
+        path = self.args.get("metrics_prometheus_path")
+        if path:
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self.metrics.render_prometheus())
+            os.replace(tmp, path)
@@ -1,56 +1,267 @@
 import hassapi as hass
 import datetime
-class BatteryCheck(hass.Hass):
+import json
+import os
+import re
+from collections import deque
+from app_metrics import MetricsMixin, log_debug, timed
+
+DEFAULT_HISTORY_SIZE = 64
+DEFAULT_FORECAST_WARNING_DAYS = 7
+MIN_FORECAST_SPAN_SECONDS = 6 * 3600
+# a jump up by this many percent means the battery was replaced
+BATTERY_REPLACED_DELTA = 10
+
+class BatteryCheck(MetricsMixin, hass.Hass):
 
     def initialize(self):
+        self.blacklist = self._compile_blacklist(self.args.get("friendly_name_blacklist") or [])
+        self.table_path = self.args.get("table_path") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "battery_check.json")
+        # entity_id -> {"last_updated", "battery", "friendly_name"} for battery powered devices
+        self.table = self._load_table()
+        # entity_id -> last_updated of entities without a battery value
+        self.skipped = {}
         time = datetime.time(6, 00, 0)
-        self.run_daily(self.check_batteries, time) 
-        
+        if self.args.get("track", False):
+            self._start_tracking()
+            self.run_daily(self.report_batteries, time)
+        else:
+            self.run_daily(self.check_batteries, time)
+        self.start_metrics()
+
+    def _start_tracking(self):
+        # one snapshot to discover battery devices, afterwards state changes keep the table current
+        self.history_size = self.args.get("history_size", DEFAULT_HISTORY_SIZE)
+        self.forecast_warning_days = self.args.get("forecast_warning_days", DEFAULT_FORECAST_WARNING_DAYS)
+        # entity_id -> deque of (timestamp, battery)
+        self.readings = {}
+        # entity_id -> (days until below threshold, slope per day), published values only
+        self.forecasts = {}
+        self.warned = set()
+        self.summary = None
+
+        self._scan(self.get_state())
+        self._save_table()
+        for device, entry in self.table.items():
+            self._add_reading(device, entry["battery"])
+            self.listen_state(self.on_battery_changed, device, attribute="all")
+        self._publish_summary()
+
+    @staticmethod
+    def _compile_blacklist(names):
+        if len(names) == 0:
+            return None
+        return re.compile("|".join(re.escape(n) for n in names))
+
+    def _load_table(self):
+        try:
+            with open(self.table_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_table(self):
+        tmp = self.table_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.table, f)
+        os.replace(tmp, self.table_path)
+
+    @timed()
     def check_batteries(self, kwargs):
         self.log("Battery checked")
-        devices = self.get_state()
+        if self._scan(self.get_state()):
+            self._save_table()
+        self._report(kwargs)
+
+    @timed()
+    def report_batteries(self, kwargs):
+        self.log("Battery checked")
+        self.refresh_forecasts(kwargs)
+        self._save_table()
+        self._report(kwargs)
+
+    @timed()
+    def refresh_forecasts(self, kwargs):
+        # the levels are still unchanged as of now, so forecasts of silent devices flatten out too
+        for device, entry in self.table.items():
+            self._add_reading(device, entry["battery"])
+        self._publish_summary()
+
+    @timed()
+    def on_battery_changed(self, entity, attribute, old, new, kwargs):
+        if new is None:
+            return
+        entry = self._evaluate(entity, new)
+        if entry is None:
+            return
+        self.table[entity] = entry
+        self._add_reading(entity, entry["battery"])
+        self._publish_summary()
+
+    def _add_reading(self, device, battery):
+        readings = self.readings.get(device)
+        now = self.get_now().timestamp()
+        if readings is None:
+            readings = self.readings[device] = deque(maxlen=self.history_size)
+        elif len(readings) > 1 and readings[-1][1] == battery and readings[-2][1] == battery:
+            # a plateau keeps its first and its latest point, so a flat level flattens the slope
+            readings[-1] = (now, battery)
+            self._update_forecast(device)
+            return
+        elif len(readings) > 0 and battery - readings[-1][1] >= BATTERY_REPLACED_DELTA:
+            readings.clear()
+            self.warned.discard(device)
+        readings.append((now, battery))
+        self._update_forecast(device)
+
+    @staticmethod
+    def _fit_slope(readings):
+        # least squares slope of the battery level in percent per day
+        n = len(readings)
+        if n < 2 or readings[-1][0] - readings[0][0] < MIN_FORECAST_SPAN_SECONDS:
+            return None
+        t0 = readings[0][0]
+        mean_t = sum((t - t0) for t, _ in readings) / n
+        mean_v = sum(v for _, v in readings) / n
+        var_t = sum((t - t0 - mean_t) ** 2 for t, _ in readings)
+        if var_t == 0:
+            return None
+        cov = sum((t - t0 - mean_t) * (v - mean_v) for t, v in readings)
+        return cov / var_t * 86400
+
+    def _update_forecast(self, device):
+        entry = self.table[device]
+        if self.blacklist is not None and self.blacklist.search(entry["friendly_name"]):
+            return
+
+        readings = self.readings[device]
+        slope = self._fit_slope(readings)
+        threshold = float(self.args["threshold"])
+        days = None
+        if slope is not None and slope < 0:
+            days = max(0.0, (readings[-1][1] - threshold) / -slope)
+            days = round(days, 1)
+
+        if device in self.forecasts and self.forecasts[device][0] == days:
+            return
+        self.forecasts[device] = (days, slope)
+        self.set_state(
+            "sensor.battery_forecast_{}".format(device.split(".", 1)[1]),
+            state=days if days is not None else "unknown",
+            friendly_name=entry["friendly_name"],
+            battery=entry["battery"],
+            slope_per_day=round(slope, 3) if slope is not None else None
+        )
+
+        if days is None or days >= self.forecast_warning_days:
+            self.warned.discard(device)
+        elif device not in self.warned:
+            self.warned.add(device)
+            message = "{} will drop below {}% in about {} days (now {}%)".format(entry["friendly_name"], self.args["threshold"], days, entry["battery"])
+            self.log("WARNING: " + message, level="WARNING")
+            self.call_service('notify/notify', title="WARNING: Battery draining", message=message)
+
+    def _publish_summary(self):
+        soonest = None
+        for device, (days, _) in self.forecasts.items():
+            if days is not None and (soonest is None or days < self.forecasts[soonest][0]):
+                soonest = device
+        threshold = float(self.args["threshold"])
+        low = sum(1 for e in self.table.values() if e["battery"] < threshold)
+        summary = (self.forecasts[soonest][0] if soonest is not None else "unknown", soonest, low, len(self.table))
+        if summary == self.summary:
+            return
+        self.summary = summary
+        self.set_state(
+            "sensor.battery_forecast_summary",
+            state=summary[0],
+            device=self.table[soonest]["friendly_name"] if soonest is not None else None,
+            low=low,
+            tracked=len(self.table)
+        )
+
+    def _scan(self, devices):
+        # single pass over the snapshot, only entities updated since the last run are evaluated
+        table = {}
+        skipped = {}
+        changed = False
+        for device, state in devices.items():
+            if "group" in device:
+                continue
+            last_updated = state.get("last_updated")
+            entry = self.table.get(device)
+            if entry is not None and last_updated is not None and entry["last_updated"] == last_updated:
+                table[device] = entry
+                continue
+            if last_updated is not None and self.skipped.get(device) == last_updated:
+                skipped[device] = last_updated
+                continue
+
+            entry = self._evaluate(device, state)
+            if entry is None:
+                skipped[device] = last_updated
+            else:
+                table[device] = entry
+            changed = changed or entry != self.table.get(device)
+
+        changed = changed or len(table) != len(self.table)
+        self.table = table
+        self.skipped = skipped
+        return changed
+
+    def _evaluate(self, device, state):
+        attributes = state.get("attributes") or {}
+        battery = None
+        if "battery" in attributes:
+            battery = attributes["battery"]
+        if "battery_level" in attributes:
+            battery = attributes["battery_level"]
+        if device.endswith("battery_level") or device.endswith("battery"):
+            battery = state.get("state")
+        if battery is None:
+            return None
+
+        try:
+            battery = float(battery)
+        except (TypeError, ValueError):
+            log_debug(self, "{} has no numeric battery value ({})", device, battery)
+            return None
+
+        try:
+            friendly_name = attributes["group"]['group.battery_group']['friendly_name']
+        except (KeyError, TypeError):
+            friendly_name = attributes.get("friendly_name", device)
+
+        return {"last_updated": state.get("last_updated"), "battery": battery, "friendly_name": friendly_name}
+
+    def _report(self, kwargs):
+        notification = self._report_notification(kwargs)
+        if notification is not None:
+            self.call_service('notify/notify', title=notification[0], message=notification[1])
+            self.call_service('persistent_notification/create', title=notification[0], message=notification[1])
+
+    def _report_notification(self, kwargs):
+        # logs the result, returns (title, message) when a notification is due
+        threshold = float(self.args["threshold"])
         values = {}
         low = []
-        for device in devices:        
-            battery = None
-            if "group" not in device:
-                try:
-                    if "battery" in devices[device]["attributes"]:
-                        battery = devices[device]["attributes"]["battery"]
-                    if "battery_level" in devices[device]["attributes"]:
-                        battery = devices[device]["attributes"]["battery_level"]
-                    if device.endswith("battery_level") or device.endswith("battery"):
-                        battery = float(self.get_state(device))
-                except TypeError:
-                    self.error("{} is not scriptable.".format(device))
-
-            if battery != None:
-                try:
-                    friendly_name = self.get_state(device, attribute="group")['group.battery_group']['friendly_name']
-                except TypeError:
-                    friendly_name = self.get_state(device, attribute="friendly_name")
-
-                blacklisted = False
-                for skip in self.args["friendly_name_blacklist"]:
-                    if skip in friendly_name:
-                        blacklisted = True
-                if blacklisted:
-                    continue
-
-                if battery < float(self.args["threshold"]):
-                    low.append(friendly_name)
-                values[friendly_name] = battery
-        
+        for entry in self.table.values():
+            friendly_name = entry["friendly_name"]
+            if self.blacklist is not None and self.blacklist.search(friendly_name):
+                continue
+            if entry["battery"] < threshold:
+                low.append(friendly_name)
+            values[friendly_name] = entry["battery"]
+
         message = ""
         if low:
             for device in low:
                 message = message + device + " \n"
-        
+
         if low or ("always_send" in self.args and self.args["always_send"] == "1") or ("force" in kwargs and kwargs["force"] == 1):
-            title = "WARNING: Battery low (below {}%)".format(self.args["threshold"])  
-            self.call_service('notify/notify', title=title, message=message)
-            self.call_service('persistent_notification/create', title=title, message=message)
+            title = "WARNING: Battery low (below {}%)".format(self.args["threshold"])
             self.log("WARNING: Batteries below threshold {}".format(self.args["threshold"]), level="WARNING")
             self.log(message, level="WARNING")
-        else:
-            self.log("All good, No batteries below threshold {}".format(self.args["threshold"]))
\ No newline at end of file
+            return (title, message)
+        self.log("All good, No batteries below threshold {}".format(self.args["threshold"]))
+        return None
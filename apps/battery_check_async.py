@@ -0,0 +1,29 @@
+import asyncio
+from app_metrics import timed
+from battery_check import BatteryCheck
+
+class BatteryCheckAsync(BatteryCheck):
+    # daily scan and report awaited on the event loop, the table is written in an executor thread
+
+    @timed()
+    async def check_batteries(self, kwargs):
+        self.log("Battery checked")
+        if self._scan(await self.get_state()):
+            await self.run_in_executor(self._save_table)
+        await self._report_async(kwargs)
+
+    @timed()
+    async def report_batteries(self, kwargs):
+        self.log("Battery checked")
+        # the forecasts are shared with the sync state callbacks, refresh them on the app's worker thread
+        await self.run_in(self.refresh_forecasts, 0)
+        await self.run_in_executor(self._save_table)
+        await self._report_async(kwargs)
+
+    async def _report_async(self, kwargs):
+        notification = self._report_notification(kwargs)
+        if notification is not None:
+            await asyncio.gather(
+                self.call_service('notify/notify', title=notification[0], message=notification[1]),
+                self.call_service('persistent_notification/create', title=notification[0], message=notification[1])
+            )
@@ -1,36 +1,80 @@
 import hassapi as hass
 import datetime
+from app_metrics import MetricsMixin, timed
 
-class InputSelect(hass.Hass):
+class InputSelect(MetricsMixin, hass.Hass):
+    # resets input selects to their default value at a given time of day. Either one
+    # entity (entity_id, default_value, default_reset_time) or a list of `selectors`
     def initialize(self):
-        self.entity_id = self.args["entity_id"]
-        self.default_value = self.args["default_value"]
-        self.default_reset_time = self.args["default_reset_time"]
-
-        self.handle = None
-        self.listen_state(self.on_state_changed, self.entity_id)
-        self.publish_next_change(None, None)
-        self.schedule_reset()
-
-    def on_state_changed(self, *args, **kwargs):
-        self.schedule_reset()
-
-    def schedule_reset(self):
-        state = self.get_state(self.entity_id)
-        self.log("InputSelect {}: clearing timer".format(self.name))
-        if self.handle is not None:
-            self.cancel_timer(self.handle)
-            self.handle = None
-            self.publish_next_change(None, None)
-        if state != self.default_value:
-            self.log("InputSelect {}: scheduling reset".format(self.name))
-            self.handle = self.run_once(self.on_reset, self.default_reset_time)
-            self.publish_next_change(self.default_reset_time, self.default_value)
-
-    def publish_next_change(self, time, value):
-        self.set_state("sensor.{}_scheduled_change_time".format(self.name), state=self.parse_datetime(time) if time is not None else "undefined")
-        self.set_state("sensor.{}_scheduled_next_value".format(self.name), state=value if value is not None else "undefined")
+        if "selectors" in self.args:
+            selectors = [(s["entity_id"], s["default_value"], s["reset_time"]) for s in self.args["selectors"]]
+            prefix = lambda entity_id: "{}_{}".format(self.name, entity_id.split(".", 1)[1])
+        else:
+            selectors = [(self.args["entity_id"], self.args["default_value"], self.args["default_reset_time"])]
+            prefix = lambda entity_id: self.name
 
+        self.defaults = {}
+        self.reset_times = {}
+        self.sensor_prefixes = {}
+        self.groups = {}
+        for entity_id, default_value, reset_time in selectors:
+            self.defaults[entity_id] = default_value
+            self.reset_times[entity_id] = reset_time
+            self.sensor_prefixes[entity_id] = prefix(entity_id)
+            self.groups.setdefault(reset_time, set())
+
+        # one read per domain, afterwards the states come from the listen_state payloads
+        self.states = {}
+        for domain in set(e.split(".", 1)[0] for e in self.defaults):
+            states = self.get_state(domain) or {}
+            for entity_id in self.defaults:
+                if entity_id in states:
+                    self.states[entity_id] = states[entity_id]["state"]
+
+        self.handles = {}
+        self.published = {}
+        for entity_id in self.defaults:
+            self.listen_state(self.on_state_changed, entity_id)
+            self.update_reset(entity_id)
+        self.start_metrics()
+
+    @timed()
+    def on_state_changed(self, entity, attribute, old, new, kwargs):
+        if self.states.get(entity) == new:
+            return
+        self.states[entity] = new
+        self.update_reset(entity)
+
+    def update_reset(self, entity_id):
+        reset_time = self.reset_times[entity_id]
+        pending = self.groups[reset_time]
+        if self.states.get(entity_id) != self.defaults[entity_id]:
+            pending.add(entity_id)
+            if self.handles.get(reset_time) is None:
+                self.log("InputSelect {}: scheduling reset at {}".format(self.name, reset_time))
+                self.handles[reset_time] = self.run_once(self.on_reset, reset_time, reset_time=reset_time)
+            self.publish_next_change(entity_id, reset_time, self.defaults[entity_id])
+        else:
+            pending.discard(entity_id)
+            if len(pending) == 0 and self.handles.get(reset_time) is not None:
+                self.log("InputSelect {}: clearing timer for {}".format(self.name, reset_time))
+                self.cancel_timer(self.handles[reset_time])
+                self.handles[reset_time] = None
+            self.publish_next_change(entity_id, None, None)
+
+    def publish_next_change(self, entity_id, time, value):
+        values = (self.parse_datetime(time) if time is not None else "undefined", value if value is not None else "undefined")
+        if self.published.get(entity_id) == values:
+            return
+        self.published[entity_id] = values
+        prefix = self.sensor_prefixes[entity_id]
+        self.set_state("sensor.{}_scheduled_change_time".format(prefix), state=values[0])
+        self.set_state("sensor.{}_scheduled_next_value".format(prefix), state=values[1])
+
+    @timed()
     def on_reset(self, kwargs):
-        self.log("InputSelect {}: resetting ... ".format(self.name))
-        self.call_service("input_select/select_option", entity_id=self.entity_id, option=self.default_value)
\ No newline at end of file
+        reset_time = kwargs["reset_time"]
+        self.handles[reset_time] = None
+        for entity_id in sorted(self.groups[reset_time]):
+            self.log("InputSelect {}: resetting {} ... ".format(self.name, entity_id))
+            self.call_service("input_select/select_option", entity_id=entity_id, option=self.defaults[entity_id])
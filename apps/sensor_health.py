@@ -1,25 +1,174 @@
 import hassapi as hass
 import datetime
+import fnmatch
+import heapq
+from app_metrics import MetricsMixin, log_debug, timed
 
-class SensorHealth(hass.Hass):
+INVALID_STATES = ("unavailable", "unknown", None)
+
+def last_valid_change(rows):
+    # last_changed of the newest row with a measurement, a sensor dropping out is no reading
+    for row in reversed(rows):
+        if row.get("state") not in INVALID_STATES:
+            return row["last_changed"]
+    return None
+
+class SensorHealth(MetricsMixin, hass.Hass):
     def initialize(self):
-        self.run_every(self.check_health, "now", self.args["interval_seconds"])
+        # minimal, attribute free history responses where supported
+        self.minimal_history = self.args.get("minimal_history", True)
+        if "entities" in self.args:
+            self._start_watchdog()
+        else:
+            self.run_every(self.check_health, "now", self.args["interval_seconds"])
+        self.start_metrics()
 
+    @timed()
     def check_health(self, kwargs):
-        start_time = datetime.datetime.now() - datetime.timedelta(seconds = self.args["interval_seconds"])
-        history = self.get_history(entity_id=self.args["entity_id"], start_time=start_time)
-        history = [item for sublist in history for item in sublist]
-        if len(history) == 0:
+        last_changed = self._last_changes([self.args["entity_id"]]).get(self.args["entity_id"])
+        if last_changed is None:
             self.log("WARNING: sensor {} timed out. Last measurement more then {} ago, threshold {} seconds".format(self.args["entity_id"], self.args["interval_seconds"], self.args["timeout_seconds"]), level="WARNING")
             return
 
-        last_event = history[-1]
-        last_changed = self.convert_utc(last_event["last_changed"])
-
-        delta = self.get_now() - last_changed
+        delta = self.get_now() - self.convert_utc(last_changed)
         self.log("Check {}: last read {} seconds ago".format(self.args["entity_id"], int(delta.total_seconds())))
         if delta.total_seconds() > self.args["timeout_seconds"]:
-            message = "sensor {} timed out. Last measurement at {} ({} seconds ago), threshold {} seconds".format(self.args["entity_id"], last_event["last_changed"], int(delta.total_seconds()), self.args["timeout_seconds"])
-            self.log("WARNING: " + message, level="WARNING")
-            self.call_service('notify/notify', title="WARNING: sensor timed out", message=message)
-            self.call_service('persistent_notification/create', title="WARNING: sensor timed out", message=message)
\ No newline at end of file
+            self._report_timeout(self.args["entity_id"], last_changed, delta)
+
+    def _last_changes(self, entity_ids):
+        # most recent valid change per entity, trying the shortest window first. HA includes the state
+        # at the window start so the short window usually suffices.
+        res = {}
+        windows = sorted({self.args["timeout_seconds"], self.args.get("interval_seconds", self.args["timeout_seconds"])})
+        for seconds in windows:
+            missing = [e for e in entity_ids if e not in res]
+            if len(missing) == 0:
+                break
+            start_time = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+            for rows in self._history(missing, start_time):
+                if len(rows) > 0 and rows[0].get("entity_id") in missing:
+                    last_changed = last_valid_change(rows)
+                    if last_changed is not None:
+                        res[rows[0]["entity_id"]] = last_changed
+        return res
+
+    def _history(self, entity_ids, start_time):
+        # one request for all entities
+        kwargs = {"entity_id": ",".join(entity_ids), "start_time": start_time}
+        if self.minimal_history:
+            try:
+                return self.get_history(minimal_response=True, no_attributes=True, **kwargs) or []
+            except TypeError:
+                log_debug(self, "minimal history responses not supported, falling back to full history")
+                self.minimal_history = False
+        return self.get_history(**kwargs) or []
+
+    def _report_timeout(self, entity_id, last_changed, delta):
+        message = self._timeout_message(entity_id, last_changed, delta)
+        self.call_service('notify/notify', title="WARNING: sensor timed out", message=message)
+        self.call_service('persistent_notification/create', title="WARNING: sensor timed out", message=message)
+
+    def _timeout_message(self, entity_id, last_changed, delta):
+        message = "sensor {} timed out. Last measurement at {} ({} seconds ago), threshold {} seconds".format(entity_id, last_changed, int(delta.total_seconds()), self.args["timeout_seconds"])
+        self.log("WARNING: " + message, level="WARNING")
+        return message
+
+    def _start_watchdog(self):
+        # track last_changed of all watched entities in memory, with a min-heap of deadlines behind one timer
+        self.timeout = datetime.timedelta(seconds=self.args["timeout_seconds"])
+        self.reminder = datetime.timedelta(seconds=self.args.get("interval_seconds", self.args["timeout_seconds"]))
+        self.last_changed = {}
+        # entity_id -> time of the next reminder while timed out
+        self.timed_out = {}
+        self.deadlines = []
+        self.handle = None
+        self.handle_time = None
+
+        patterns = self.args["entities"]
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        states = self.get_state()
+        entities = set()
+        for p in patterns:
+            if any(c in p for c in "*?["):
+                entities.update(fnmatch.filter(states.keys(), p))
+            else:
+                entities.add(p)
+
+        # entities without a usable current state are looked up in the history, in one bulk request
+        unknown = [e for e in sorted(entities) if states.get(e) is None or states[e].get("state") in INVALID_STATES]
+        history = self._last_changes(unknown) if len(unknown) > 0 else {}
+
+        now = self.get_now()
+        for entity_id in sorted(entities):
+            state = states.get(entity_id)
+            if entity_id in history:
+                last_changed = self.convert_utc(history[entity_id])
+            elif state is not None and state.get("last_changed") is not None:
+                last_changed = self.convert_utc(state["last_changed"])
+            else:
+                last_changed = now
+            self.last_changed[entity_id] = last_changed
+            self.deadlines.append((last_changed + self.timeout, entity_id))
+            self.listen_state(self.on_sensor_changed, entity_id)
+        heapq.heapify(self.deadlines)
+        self.log("Watching {} sensors, timeout {} seconds".format(len(self.last_changed), self.args["timeout_seconds"]))
+        self._arm()
+
+    @timed()
+    def on_sensor_changed(self, entity, attribute, old, new, kwargs):
+        self._touch(entity, self.get_now())
+        self._arm()
+
+    def _touch(self, entity, now):
+        self.last_changed[entity] = now
+        if self.timed_out.pop(entity, None) is not None:
+            self.log("sensor {} reports again".format(entity))
+        heapq.heappush(self.deadlines, (now + self.timeout, entity))
+        if len(self.deadlines) > 4 * len(self.last_changed):
+            self._compact()
+
+    def _compact(self):
+        # drop deadlines superseded by newer updates
+        self.deadlines = [d for d in self.deadlines if d[0] >= self.last_changed[d[1]] + self.timeout]
+        heapq.heapify(self.deadlines)
+
+    def _next_deadline(self):
+        # the time to arm the timer for, None if the armed timer is early enough
+        if len(self.deadlines) == 0:
+            return None
+        time = self.deadlines[0][0]
+        if self.handle is not None and self.handle_time <= time:
+            return None
+        return time
+
+    def _arm(self):
+        time = self._next_deadline()
+        if time is None:
+            return
+        if self.handle is not None:
+            self.cancel_timer(self.handle)
+        self.handle_time = time
+        self.handle = self.run_in(self._on_deadline, max(0, (time - self.get_now()).total_seconds()))
+
+    @timed()
+    def _on_deadline(self, kwargs):
+        self.handle = None
+        for entity_id, last_changed, delta in self._expire(self.get_now()):
+            self._report_timeout(entity_id, last_changed, delta)
+        self._arm()
+
+    def _expire(self, now):
+        # pops due deadlines, returns the (entity_id, last_changed, delta) to report
+        res = []
+        while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+            _, entity_id = heapq.heappop(self.deadlines)
+            delta = now - self.last_changed[entity_id]
+            if delta < self.timeout:
+                continue
+            if entity_id in self.timed_out and now < self.timed_out[entity_id]:
+                continue
+            res.append((entity_id, self.last_changed[entity_id], delta))
+            self.timed_out[entity_id] = now + self.reminder
+            heapq.heappush(self.deadlines, (now + self.reminder, entity_id))
+        return res
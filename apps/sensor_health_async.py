@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+from app_metrics import log_debug, timed
+from sensor_health import SensorHealth, last_valid_change
+
+class SensorHealthAsync(SensorHealth):
+    # history lookups, timers and notifications awaited on the event loop, reports of a deadline sent concurrently
+
+    @timed()
+    async def check_health(self, kwargs):
+        entity_id = self.args["entity_id"]
+        last_changed = (await self._last_changes_async([entity_id])).get(entity_id)
+        if last_changed is None:
+            self.log("WARNING: sensor {} timed out. Last measurement more then {} ago, threshold {} seconds".format(entity_id, self.args["interval_seconds"], self.args["timeout_seconds"]), level="WARNING")
+            return
+
+        delta = await self.get_now() - self.convert_utc(last_changed)
+        self.log("Check {}: last read {} seconds ago".format(entity_id, int(delta.total_seconds())))
+        if delta.total_seconds() > self.args["timeout_seconds"]:
+            await self._report_timeout_async(entity_id, last_changed, delta)
+
+    async def _last_changes_async(self, entity_ids):
+        res = {}
+        windows = sorted({self.args["timeout_seconds"], self.args.get("interval_seconds", self.args["timeout_seconds"])})
+        for seconds in windows:
+            missing = [e for e in entity_ids if e not in res]
+            if len(missing) == 0:
+                break
+            start_time = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+            for rows in await self._history_async(missing, start_time):
+                if len(rows) > 0 and rows[0].get("entity_id") in missing:
+                    last_changed = last_valid_change(rows)
+                    if last_changed is not None:
+                        res[rows[0]["entity_id"]] = last_changed
+        return res
+
+    async def _history_async(self, entity_ids, start_time):
+        kwargs = {"entity_id": ",".join(entity_ids), "start_time": start_time}
+        if self.minimal_history:
+            try:
+                return await self.get_history(minimal_response=True, no_attributes=True, **kwargs) or []
+            except TypeError:
+                log_debug(self, "minimal history responses not supported, falling back to full history")
+                self.minimal_history = False
+        return await self.get_history(**kwargs) or []
+
+    async def _report_timeout_async(self, entity_id, last_changed, delta):
+        message = self._timeout_message(entity_id, last_changed, delta)
+        await asyncio.gather(
+            self.call_service('notify/notify', title="WARNING: sensor timed out", message=message),
+            self.call_service('persistent_notification/create', title="WARNING: sensor timed out", message=message)
+        )
+
+    def _start_watchdog(self):
+        # arming awaits AppDaemon, callbacks interleaving there must not both replace the timer
+        self.arm_lock = asyncio.Lock()
+        super()._start_watchdog()
+
+    @timed()
+    async def on_sensor_changed(self, entity, attribute, old, new, kwargs):
+        # on the event loop like _on_deadline, the deadlines and the timer handle are never shared with worker threads
+        self._touch(entity, await self.get_now())
+        await self._arm_async()
+
+    async def _arm_async(self):
+        async with self.arm_lock:
+            time = self._next_deadline()
+            if time is None:
+                return
+            if self.handle is not None:
+                await self.cancel_timer(self.handle)
+            self.handle_time = time
+            self.handle = await self.run_in(self._on_deadline, max(0, (time - await self.get_now()).total_seconds()))
+
+    @timed()
+    async def _on_deadline(self, kwargs):
+        self.handle = None
+        expired = self._expire(await self.get_now())
+        await asyncio.gather(*[self._report_timeout_async(*x) for x in expired])
+        await self._arm_async()
@@ -0,0 +1,153 @@
+from attrs import define, field
+from array import array
+import datetime
+import gzip
+import json
+import math
+import sys
+
+DEFAULT_HISTORY_SIZE = 64
+DEFAULT_HISTORY_FLUSH_SECONDS = 600
+HISTORY_VERSION = 1
+
+# reasons are stored as their index in this tuple
+REASONS = ("sensor", "thermostat", "target", "controller")
+REASON_SENSOR, REASON_THERMOSTAT, REASON_TARGET, REASON_CONTROLLER = range(len(REASONS))
+FIELDS = ("time", "room_temperature", "target_temperature", "reason")
+
+@define
+class SetpointHistory:
+    # fixed size ring of records (time, room temperature, target, reason, setpoint per thermostat), all doubles
+    thermostats: tuple[str, ...]
+    size: int = field(default=DEFAULT_HISTORY_SIZE)
+    dropped: int = field(init=False, default=0)
+    width: int = field(init=False)
+    _buffer: array = field(init=False)
+    _head: int = field(init=False, default=0)
+    _count: int = field(init=False, default=0)
+
+    def __attrs_post_init__(self):
+        self.width = len(FIELDS) + len(self.thermostats)
+        self._buffer = array("d", bytes(8 * self.width * self.size))
+
+    def record(self, timestamp, room_temperature, target_temperature, reason, setpoints):
+        buf = self._buffer
+        i = self._head * self.width
+        buf[i] = timestamp
+        buf[i + 1] = math.nan if room_temperature is None else room_temperature
+        buf[i + 2] = math.nan if target_temperature is None else target_temperature
+        buf[i + 3] = reason
+        for k, s in enumerate(setpoints, i + 4):
+            buf[k] = math.nan if s is None else s
+        self._head = (self._head + 1) % self.size
+        if self._count == self.size:
+            # not flushed in time, the oldest record is overwritten
+            self.dropped += 1
+        else:
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def drain(self):
+        # unflushed records, oldest first
+        start = (self._head - self._count) % self.size
+        end = start + self._count
+        res = self._buffer[start * self.width:min(end, self.size) * self.width]
+        if end > self.size:
+            res.extend(self._buffer[:(end - self.size) * self.width])
+        self._count = 0
+        return res
+
+@define
+class HistoryLog:
+    # appends the rings as gzip members to `path`, one member per flush and day,
+    # and a JSON line per member to `path`.index telling where each room's records are
+    path: str
+    size: int = field(default=DEFAULT_HISTORY_SIZE)
+    rooms: dict[str, SetpointHistory] = field(init=False, factory=dict)
+    stats: dict[str, int] = field(init=False, factory=lambda: {"flushes": 0, "records": 0, "bytes": 0})
+    _layout_written: bool = field(init=False, default=False)
+
+    @property
+    def index_path(self):
+        return self.path + ".index"
+
+    def ring(self, room, thermostats):
+        self.rooms[room] = SetpointHistory(thermostats=tuple(thermostats), size=self.size)
+        return self.rooms[room]
+
+    def dropped(self):
+        return sum(r.dropped for r in self.rooms.values())
+
+    def flush(self, tz=None):
+        days = {}
+        for name, ring in self.rooms.items():
+            if len(ring) == 0:
+                continue
+            records = ring.drain()
+            width = ring.width
+            start = 0
+            while start < len(records):
+                day = datetime.datetime.fromtimestamp(records[start], tz).date()
+                end = start + width
+                while end < len(records) and datetime.datetime.fromtimestamp(records[end], tz).date() == day:
+                    end += width
+                days.setdefault(day.isoformat(), []).append((name, width, records[start:end]))
+                start = end
+        if len(days) == 0:
+            return
+
+        index = []
+        if not self._layout_written:
+            # the thermostats behind the setpoint columns, valid for all following members
+            index.append({"version": HISTORY_VERSION, "fields": FIELDS, "reasons": REASONS, "layout": {k: v.thermostats for k, v in self.rooms.items()}})
+            self._layout_written = True
+        with open(self.path, "ab") as f:
+            for day, chunks in sorted(days.items()):
+                data = array("d")
+                rooms = {}
+                for name, width, records in chunks:
+                    rooms[name] = [len(data) * 8, len(records) // width]
+                    data.extend(records)
+                    self.stats["records"] += len(records) // width
+                if sys.byteorder == "big":
+                    data.byteswap()
+                member = gzip.compress(data.tobytes())
+                index.append({"day": day, "offset": f.tell(), "length": len(member), "rooms": rooms})
+                f.write(member)
+                self.stats["bytes"] += len(member)
+        with open(self.index_path, "a") as f:
+            for line in index:
+                f.write(json.dumps(line) + "\n")
+        self.stats["flushes"] += 1
+
+def read_history(path, room, days=None):
+    # records of `room` as dicts, `days` limits them to some ISO dates
+    res = []
+    layout = {}
+    with open(path + ".index") as index, open(path, "rb") as f:
+        for line in index:
+            entry = json.loads(line)
+            if "layout" in entry:
+                layout = entry["layout"]
+                continue
+            if room not in entry["rooms"] or (days is not None and entry["day"] not in days):
+                continue
+            f.seek(entry["offset"])
+            data = array("d", gzip.decompress(f.read(entry["length"])))
+            if sys.byteorder == "big":
+                data.byteswap()
+            thermostats = layout[room]
+            width = len(FIELDS) + len(thermostats)
+            start, count = entry["rooms"][room]
+            start //= 8
+            for i in range(start, start + count * width, width):
+                res.append({
+                    "time": datetime.datetime.fromtimestamp(data[i], datetime.timezone.utc),
+                    "room_temperature": data[i + 1],
+                    "target_temperature": data[i + 2],
+                    "reason": REASONS[int(data[i + 3])],
+                    "setpoints": dict(zip(thermostats, data[i + 4:i + width])),
+                })
+    return res
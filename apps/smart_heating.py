@@ -1,144 +1,359 @@
-from attrs import define, field
-from typing import Optional, Union, Any
-from itertools import cycle
+from attrs import define, field, frozen
+from typing import Optional, Union, Any, Callable
+from itertools import cycle, count
 from collections import deque, OrderedDict
-import copy
+from bisect import bisect_right
+from functools import lru_cache
+import hashlib
+import heapq
+import json
+import math
+import os
+import threading
 import hassapi as hass
 import datetime
+from app_metrics import MetricsMixin, log_debug, timed
+from setpoint_history import HistoryLog, SetpointHistory, DEFAULT_HISTORY_SIZE, DEFAULT_HISTORY_FLUSH_SECONDS, REASON_SENSOR, REASON_THERMOSTAT, REASON_TARGET, REASON_CONTROLLER
 
-DEFAULT_SETMODE = "eco"
-
-def weekday_from_number(n):
-    l = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
-    return l[n-1]
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def weekday_str_from_list(l):
-    res = []
-    for i in l:
-        res.append(weekday_from_number(i))
-    return ",".join(res)
+DEFAULT_SETMODE = "eco"
 
-@define
+DEFAULT_UPDATE_COALESCE_SECONDS = 5
+DEFAULT_MIN_UPDATE_INTERVAL_SECONDS = 30
+DEFAULT_STATS_INTERVAL_SECONDS = 300
+DEFAULT_STATE_CACHE_MAX_AGE_SECONDS = 600
+DEFAULT_MAX_SERVICE_CALLS_PER_SECOND = 5
+DEFAULT_SNAPSHOT_INTERVAL_SECONDS = 300
+# sensor values older than this are read from HA again on startup
+DEFAULT_SNAPSHOT_MAX_AGE_SECONDS = 900
+SNAPSHOT_VERSION = 1
+# readings lose half their weight against fresher sensors every tau * ln 2 seconds
+DEFAULT_SENSOR_TAU_SECONDS = 1800
+DEFAULT_OUTLIER_DELTA = 2.0
+# changes of the fused temperature below this do not update the thermostats
+DEFAULT_TEMPERATURE_DEADBAND = 0.1
+OUTLIER_DEVIATIONS = 4
+OUTLIER_ACCEPT_COUNT = 3
+SENSOR_EWMA_ALPHA = 0.3
+# fusion weights are rebased before they grow past exp(34) ~ 6e14, sums stay exact to ~0.1
+MAX_WEIGHT_EXPONENT = 34
+DEFAULT_CONTROLLER_INTERVAL_SECONDS = 900
+
+# keys of an app config that belong to AppDaemon, not to the app's arguments
+APPDAEMON_APP_KEYS = ("name", "config_path", "module", "class", "dependencies", "disable", "priority", "pin_app", "pin_thread", "log", "log_level")
+
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_WEEK = 7 * SECONDS_PER_DAY
+
+def seconds_of_week(weekday, time):
+    return (weekday - 1) * SECONDS_PER_DAY + time.hour * 3600 + time.minute * 60 + time.second
+
+def local_datetime(tz, date, seconds):
+    # wall clock time on `date`, pytz zones (AppDaemon) need localize() to get the UTC offset of that day
+    naive = datetime.datetime.combine(date, datetime.time()) + datetime.timedelta(seconds=seconds)
+    if hasattr(tz, "localize"):
+        return tz.normalize(tz.localize(naive))
+    return naive.replace(tzinfo=tz)
+
+ALL_WEEKDAYS = 0b1111111
+
+def weekday_mask(weekdays):
+    # isoweekday d is bit d - 1
+    mask = 0
+    for d in weekdays:
+        mask |= 1 << (d - 1)
+    return mask
+
+@frozen
 class ScheduleItem:
     start: datetime.time
     end: datetime.time
     setmode: str
-    weekdays: Optional[list[int]] = field(default=None)
-    
+    weekdays: int = field(default=ALL_WEEKDAYS)
+
+    def days(self):
+        return [d for d in range(1, 8) if self.weekdays & (1 << (d - 1))]
+
     @staticmethod
     def _parse_weekdays(s: str):
-        tokens = s.split('s')
-        res = []
-        for t in tokens:
-            if '-' in t:
-                start, _, end = s.partition('-')
-                res.extend(list(range(int(start), int(end) + 1)))
-            else:
-                res.append(int(t))
-        return res
+        # "1-3,5" -> 0b0010111
+        mask = 0
+        for t in str(s).split(','):
+            start, sep, end = t.partition('-')
+            if sep and int(start) > int(end):
+                raise ValueError("reversed weekday range '{}' in '{}', list wrapping days like '6-7,1'".format(t, s))
+            days = range(int(start), int(end) + 1) if sep else [int(start)]
+            for d in days:
+                if d < 1 or d > 7:
+                    raise ValueError("invalid weekday {} in '{}'".format(d, s))
+            mask |= weekday_mask(days)
+        return mask
 
     @classmethod
     def from_dict(cls, dct):
+        return _parse_item(dct["start"], dct["end"], dct["setmode"], str(dct["weekdays"]) if "weekdays" in dct else None)
+
+@lru_cache(maxsize=None)
+def _parse_item(start, end, setmode, weekdays):
+    # identical items are parsed once and shared between schedules
+    return ScheduleItem(
+        setmode=setmode,
+        start=datetime.time.fromisoformat(start),
+        end=datetime.time.fromisoformat(end),
+        weekdays=ScheduleItem._parse_weekdays(weekdays) if weekdays is not None else ALL_WEEKDAYS
+    )
+
+@frozen(cache_hash=True)
+class CompiledSchedule:
+    # the mode switches of the week, in seconds of the week
+    transition_times: tuple[int, ...]
+    transition_modes: tuple[str, ...]
+
+    @classmethod
+    def from_items(cls, name, items):
+        # items ending at or before their start run over midnight into the next day
+        intervals = []
+        for i in items:
+            if i.start == i.end:
+                raise ValueError("schedule {}: item {}-{} is empty".format(name, i.start, i.end))
+            for weekday in i.days():
+                start = seconds_of_week(weekday, i.start)
+                end = seconds_of_week(weekday, i.end)
+                if end > start:
+                    intervals.append((start, end, i))
+                    continue
+                day_end = weekday * SECONDS_PER_DAY
+                intervals.append((start, day_end, i))
+                if end > day_end - SECONDS_PER_DAY:
+                    next_day = (day_end % SECONDS_PER_WEEK)
+                    intervals.append((next_day, next_day + end - (day_end - SECONDS_PER_DAY), i))
+        intervals.sort(key=lambda x: x[0])
+        for a, b in zip(intervals, intervals[1:]):
+            if b[0] < a[1]:
+                raise ValueError("schedule {}: items {}-{} and {}-{} overlap on weekday {}".format(
+                    name, a[2].start, a[2].end, b[2].start, b[2].end, b[0] // SECONDS_PER_DAY + 1))
+
+        # a start wins over an end at the same time
+        transitions = {}
+        for start, end, i in intervals:
+            transitions.setdefault(end % SECONDS_PER_WEEK, DEFAULT_SETMODE)
+        for start, end, i in intervals:
+            transitions[start] = i.setmode
+        times = sorted(transitions)
         return cls(
-            setmode=dct["setmode"],
-            start=datetime.time.fromisoformat(dct["start"]),
-            end=datetime.time.fromisoformat(dct["end"]),
-            weekdays=cls._parse_weekdays(dct["weekdays"]) if "weekdays" in dct else list(range(1,8))
+            transition_times=tuple(times),
+            transition_modes=tuple(transitions[t] for t in times)
         )
 
-@define
+@frozen
 class Schedule:
-    items: list[ScheduleItem]
+    items: tuple[ScheduleItem, ...]
     name: str
+    compiled: CompiledSchedule = field(eq=False, repr=False)
+
+    @compiled.default
+    def _compile(self):
+        return CompiledSchedule.from_items(self.name, self.items)
 
     @classmethod
     def from_list(cls, name, l):
-        items = [ScheduleItem.from_dict(d) for d in l]
-        items.sort(key=lambda i: i.start)
-        return cls(name=name, items=items)
-
-    def get_item_at(self, weekday, time):
-        for i in self.items:
-            if i.start <= time and i.end > time and weekday in i.weekdays:
-                return i
-        return None
-
-    def get_next_item_at(self, weekday, time, remaining_weekdays=7):
-        # assumes a sorted schedule with no overlaps and no items schedule over midnight!
-        l = []
-        for i in self.items:
-            if weekday in i.weekdays:
-                l.append(i)
-
-        for i in l:
-            if time < i.start:
-                return ("next", i, 7 - remaining_weekdays)
-            if time >= i.start and time < i.end:
-                return ("current", i, 7 - remaining_weekdays)
-
-        if remaining_weekdays == 0:
-            return None
-
-        res = self.get_next_item_at(weekday % 7 + 1, datetime.time(0,0,1), remaining_weekdays=remaining_weekdays-1)
-        if res is not None:
-            return res
-
-        return None
-
-    def get_item_at_datetime(self, dt):
-        return self.get_item_at(dt.isoweekday(), dt.time())
-
-    def get_next_item_at_datetime(self, dt):
-        n = self.get_next_item_at(dt.isoweekday(), dt.time())
-        date = datetime.date.today() + datetime.timedelta(days=n[2])
-        return (n, date)
+        # schedules with identical items are compiled once, across apps and reloads of apps.yaml
+        key = schedule_key(l)
+        template = _compiled_schedules.get(key)
+        if template is not None:
+            return cls(name=name, items=template.items, compiled=template.compiled)
+        items = tuple(sorted((ScheduleItem.from_dict(d) for d in l), key=lambda i: i.start))
+        schedule = cls(name=name, items=items)
+        _compiled_schedules[key] = schedule
+        return schedule
+
+# schedule_key of a schedule's items -> first schedule compiled from them
+_compiled_schedules = {}
+
+def schedule_key(l):
+    # the parsed fields of a schedule's config, cheaper to build than a json dump
+    return tuple((d["start"], d["end"], d["setmode"], str(d.get("weekdays"))) for d in l)
+
+# schedules config -> compiled schedules, shared by all app instances (shards) of this module
+_schedule_registry = {}
+
+def shared_schedules(config):
+    key = tuple((name, schedule_key(l)) for name, l in config.items())
+    if key not in _schedule_registry:
+        _schedule_registry[key] = {name: Schedule.from_list(name, l) for name, l in config.items()}
+    return _schedule_registry[key]
 
+@define
+class StateCache:
+    # write-through cache for entity reads, fed by state listeners and our own service calls
+    hass: hass
+    max_age_seconds: float = field(default=DEFAULT_STATE_CACHE_MAX_AGE_SECONDS)
+    _values: dict[tuple[str, Optional[str]], tuple[Any, datetime.datetime]] = field(init=False, factory=dict)
+
+    def get(self, entity_id, attribute=None, refresh=False):
+        key = (entity_id, attribute)
+        now = self.hass.get_now()
+        if not refresh and key in self._values:
+            value, time = self._values[key]
+            if (now - time).total_seconds() <= self.max_age_seconds:
+                return value
+        value = self.hass.get_state(entity_id, attribute=attribute)
+        self._values[key] = (value, now)
+        return value
+
+    def put(self, entity_id, attribute, value, time=None):
+        self._values[(entity_id, attribute)] = (value, time if time is not None else self.hass.get_now())
+
+    def dump(self):
+        return [[k[0], k[1], v[0], v[1].isoformat()] for k, v in self._values.items()]
+
+    def load(self, entries):
+        for entity_id, attribute, value, time in entries:
+            self.put(entity_id, attribute, value, datetime.datetime.fromisoformat(time))
 
 @define
+class ClimateDispatcher:
+    # collects the desired setpoints of the house, drops no-op and superseded writes and sends the rest paced
+    hass: hass
+    state_cache: StateCache
+    max_calls_per_second: int = field(default=DEFAULT_MAX_SERVICE_CALLS_PER_SECOND)
+    stats: dict[str, int] = field(init=False, factory=lambda: {"requested": 0, "sent": 0, "noop": 0, "superseded": 0})
+    _pending: dict[str, float] = field(init=False, factory=dict)
+    # taken by a flush and not yet in the state cache
+    _inflight: dict[str, float] = field(init=False, factory=dict)
+    _flushing: bool = field(init=False, default=False)
+    # rooms request writes from worker threads, async variants flush on the event loop.
+    # Never held across an AppDaemon call, those wait for the loop
+    _lock: Any = field(init=False, factory=threading.Lock)
+
+    def set_temperature(self, entity_id, temperature, force=False):
+        # read before locking, a cache miss asks HA
+        current = self.state_cache.get(entity_id, "temperature") if not force else None
+        with self._lock:
+            self.stats["requested"] += 1
+            current = self._inflight.get(entity_id, current)
+            if entity_id in self._pending:
+                if not force and self._pending[entity_id] == temperature:
+                    self.stats["noop"] += 1
+                    return False
+                self.stats["superseded"] += 1
+                del self._pending[entity_id]
+
+            if not force and temperature == current:
+                self.stats["noop"] += 1
+                return False
+
+            self._pending[entity_id] = temperature
+            schedule = not self._flushing
+            self._flushing = True
+        if schedule:
+            self.hass.run_in(self._flush, 0)
+        return True
+
+    def pending_temperature(self, entity_id):
+        with self._lock:
+            return self._pending.get(entity_id, self._inflight.get(entity_id))
+
+    def commanded_temperature(self, entity_id):
+        # the setpoint the entity has or is about to get
+        pending = self.pending_temperature(entity_id)
+        return pending if pending is not None else self.state_cache.get(entity_id, "temperature")
+
+    def saved_writes(self):
+        return self.stats["noop"] + self.stats["superseded"]
+
+    @timed()
+    def _flush(self, kwargs):
+        # the flag stays set while sending, so writes requested meanwhile wait for the next batch
+        batch = self._take_batch()
+        attempted = 0
+        try:
+            for entity_id, temperature in batch:
+                attempted += 1
+                self.hass.call_service("climate/set_temperature", entity_id=entity_id, temperature=temperature)
+                self.state_cache.put(entity_id, "temperature", temperature)
+                self.stats["sent"] += 1
+        finally:
+            self._finish_batch(batch, attempted)
+            if self._more_pending():
+                self.hass.run_in(self._flush, 1)
+
+    def _take_batch(self):
+        with self._lock:
+            batch = []
+            for _ in range(self.max_calls_per_second):
+                if len(self._pending) == 0:
+                    break
+                entity_id = next(iter(self._pending))
+                temperature = self._pending.pop(entity_id)
+                self._inflight[entity_id] = temperature
+                batch.append((entity_id, temperature))
+            return batch
+
+    def _finish_batch(self, batch, attempted):
+        # sent setpoints are in the state cache now. A failed call keeps the stale cache value, so the next
+        # update of its room requests it again. Entries behind it go back to _pending unless superseded
+        with self._lock:
+            for entity_id, temperature in batch:
+                if self._inflight.get(entity_id) == temperature:
+                    del self._inflight[entity_id]
+            for entity_id, temperature in batch[attempted:]:
+                self._pending.setdefault(entity_id, temperature)
+
+    def _more_pending(self):
+        # clears the flag when done, a write requested afterwards schedules its own flush
+        with self._lock:
+            self._flushing = len(self._pending) > 0
+            return self._flushing
+
+@frozen
 class Thermostat:
     hass: hass
     entity_id: str
+    state_cache: StateCache
+    dispatcher: ClimateDispatcher
     alpha: float = field(default=0.)
     offset: float = field(default=0.)
 
     MAX_TEMP_SETTING = 28.0
     MIN_TEMP_SETTING = 17.0
 
-    def get_temperature_setting(self):
-        entity = self.hass.get_entity(self.entity_id)
-        return entity.get_state(attribute="temperature")
+    def get_temperature_setting(self, refresh=False):
+        return self.state_cache.get(self.entity_id, "temperature", refresh=refresh)
 
-    def get_measured_temperature(self):
-        entity = self.hass.get_entity(self.entity_id)
-        return entity.get_state(attribute="current_temperature")
+    def get_measured_temperature(self, refresh=False):
+        return self.state_cache.get(self.entity_id, "current_temperature", refresh=refresh)
 
-    def set_temperature(self, target_temperature, current_temperature, force=False):
+    def compute_setpoint(self, target_temperature, current_temperature, current_measurement):
+        # keep HouseController._compute_vectorized in line with this
         delta = target_temperature - current_temperature
-        new_temperature = target_temperature
-
-        current_measurement = self.get_measured_temperature()
         if delta > 0:
             new_temperature = round((current_measurement + self.alpha*delta + self.offset)*2.)/2.
-            new_temperature = min(max(new_temperature, target_temperature), Thermostat.MAX_TEMP_SETTING)
-        else:
-            new_temperature = Thermostat.MIN_TEMP_SETTING
+            return min(max(new_temperature, target_temperature), Thermostat.MAX_TEMP_SETTING)
+        return Thermostat.MIN_TEMP_SETTING
+
+    def set_temperature(self, target_temperature, current_temperature, force=False):
+        current_measurement = self.get_measured_temperature(refresh=force)
+        new_temperature = self.compute_setpoint(target_temperature, current_temperature, current_measurement)
 
-        current_setting = self.get_temperature_setting()
+        current_setting = self.get_temperature_setting(refresh=force)
 
-        if force or new_temperature != current_setting:
-            self.hass.log("[Thermostat] {} setting {} -> {} (target: {}, alpha: {}, forced: {})".format(self.entity_id, current_setting, new_temperature, target_temperature, self.alpha, force), level="DEBUG")
-            self.hass.call_service("climate/set_temperature", entity_id=self.entity_id, temperature=new_temperature)
+        if self.dispatcher.set_temperature(self.entity_id, new_temperature, force=force):
+            log_debug(self.hass, "[Thermostat] {} setting {} -> {} (target: {}, alpha: {}, forced: {})", self.entity_id, current_setting, new_temperature, target_temperature, self.alpha, force)
         else:
-            self.hass.log("[Thermostat] {}: No setting change (setting: {}, target: {})".format(self.entity_id, current_setting, target_temperature), level="DEBUG")
-        self.hass.log("[Thermostat] {}: temp delta (power output) {} (room temp: {}, new temp: {}, thermostat temp: {})".format(self.entity_id, new_temperature - current_measurement, current_temperature, new_temperature, current_measurement), level="DEBUG")
+            log_debug(self.hass, "[Thermostat] {}: No setting change (setting: {}, target: {})", self.entity_id, current_setting, target_temperature)
+        log_debug(self.hass, "[Thermostat] {}: temp delta (power output) {} (room temp: {}, new temp: {}, thermostat temp: {})", self.entity_id, new_temperature - current_measurement, current_temperature, new_temperature, current_measurement)
+        return new_temperature
 
 @define
 class Selector:
     entity_id: str
     states: Union[dict[str, Schedule], Schedule]
 
-TEMPERATURE_SENSOR_UPDATED="smart_heating_temperature_sensor_updated"
-
 @define
 class TemperatureSensor:
     hass: hass
@@ -146,14 +361,21 @@ class TemperatureSensor:
     last_value_time: Optional[datetime.datetime] = field(init=False)
     last_value: Optional[float] = field(init=False)
     threshold: float = field(default=0.0)
+    on_update: Optional[Callable[[str, Optional[float]], None]] = field(default=None)
+    # (value, time) to start from instead of reading the sensor
+    initial: Optional[tuple[Optional[float], datetime.datetime]] = field(default=None)
 
     def __attrs_post_init__(self):
         entity = self.hass.get_entity(self.entity_id)
         if entity is None:
-            raise ValueError("Temperature sensor " + entity_id + " not found in HASS")
-        self.last_value = self.measure_temperature()
-        self.last_value_time = self.hass.get_now()
-        entity.listen_state(self.on_change)
+            raise ValueError("Temperature sensor " + self.entity_id + " not found in HASS")
+        if self.initial is not None:
+            self.last_value, self.last_value_time = self.initial
+        else:
+            self.last_value = self.measure_temperature()
+            self.last_value_time = self.hass.get_now()
+        # every report, not only changed values, tells the sensor is still alive
+        entity.listen_state(self.on_change, attribute="all")
 
     def measure_temperature(self):
         return self._valid_temperature_or_none(self.hass.get_state(self.entity_id))
@@ -167,21 +389,136 @@ class TemperatureSensor:
     def _valid_temperature_or_none(self, value):
         try:
             return float(value) 
-        except ValueError:
+        except (TypeError, ValueError):
             return None
 
+    @timed()
     def on_change(self, entity, attribute, old, new, kwargs):
-        self.hass.log("[TempSensor] {} temperature {} -> {}".format(self.entity_id, old, new), level="DEBUG")
-        new_temp = self._valid_temperature_or_none(new)
+        new = new or {}
+        log_debug(self.hass, "[TempSensor] {} temperature {} -> {}", self.entity_id, (old or {}).get("state"), new.get("state"))
+        new_temp = self._valid_temperature_or_none(new.get("state"))
+        reported = new.get("last_reported") or new.get("last_updated")
+        time = self.hass.convert_utc(reported) if reported is not None else self.hass.get_now()
         changed_from_to_none = new_temp != self.last_value and (new_temp is None or self.last_value is None) 
-        if changed_from_to_none or abs(new_temp - self.last_value) > self.threshold:
+        if changed_from_to_none or (new_temp is not None and abs(new_temp - self.last_value) > self.threshold):
             self.last_value = new_temp
-            self.last_value_time = self.hass.get_now()
-            self.hass.fire_event(TEMPERATURE_SENSOR_UPDATED, entity_id=self.entity_id, temperature=self.last_value)
+        elif new_temp is None or (self.last_value_time is not None and time <= self.last_value_time):
+            return
+        # values within the threshold keep the last value but refresh its time
+        self.last_value_time = time
+        if self.on_update is not None:
+            self.on_update(self.entity_id, self.last_value)
 
     @classmethod
-    def create(cls, hass, entity_id):
-        return cls(hass=hass, entity_id=entity_id)
+    def create(cls, hass, entity_id, on_update=None, initial=None):
+        return cls(hass=hass, entity_id=entity_id, on_update=on_update, initial=initial)
+
+@define
+class SensorStats:
+    mean: Optional[float] = field(default=None)
+    deviation: float = field(default=0.)
+    rejected: int = field(default=0)
+    value: Optional[float] = field(default=None)
+    timestamp: float = field(default=0.)
+    weight: float = field(default=0.)
+
+@define
+class TemperatureFusion:
+    # freshness weighted mean of the room's sensors, updated incrementally per reading
+    sensors: list[TemperatureSensor]
+    tau_seconds: float = field(default=DEFAULT_SENSOR_TAU_SECONDS)
+    outlier_delta: float = field(default=DEFAULT_OUTLIER_DELTA)
+    deadband: float = field(default=DEFAULT_TEMPERATURE_DEADBAND)
+    _stats: dict[str, SensorStats] = field(init=False, factory=dict)
+    _sensors: dict[str, TemperatureSensor] = field(init=False, factory=dict)
+    _count: int = field(init=False, default=0)
+    # weights are exp((timestamp - t0) / tau), t0 is moved forward before they lose precision
+    _t0: Optional[float] = field(init=False, default=None)
+    _sum_weights: float = field(init=False, default=0.)
+    _sum_values: float = field(init=False, default=0.)
+    _reported: Optional[float] = field(init=False, default=None)
+
+    def __attrs_post_init__(self):
+        for sensor in self.sensors:
+            self._sensors[sensor.entity_id] = sensor
+            self._stats[sensor.entity_id] = SensorStats()
+        for sensor in self.sensors:
+            self.update(sensor.entity_id)
+        self._reported = self.value()
+
+    def value(self):
+        if self._count == 0:
+            return None
+        if self._sum_weights <= 0:
+            values = [s.value for s in self._stats.values() if s.value is not None]
+            return sum(values) / len(values)
+        return self._sum_values / self._sum_weights
+
+    def update(self, entity_id):
+        # returns True when the fused temperature moved by more than the deadband
+        sensor = self._sensors[entity_id]
+        stats = self._stats[entity_id]
+        value = sensor.last_value
+        timestamp = sensor.last_value_time.timestamp() if sensor.last_value_time is not None else 0.
+        # a refreshed reading was accepted before, only its weight moves
+        if value is not None and value != stats.value and not self._accept(stats, value):
+            return False
+
+        if stats.value is not None:
+            self._count -= 1
+            self._sum_weights -= stats.weight
+            self._sum_values -= stats.weight * stats.value
+        stats.value, stats.timestamp, stats.weight = value, timestamp, 0.
+        if value is not None:
+            self._count += 1
+            if self._t0 is None or (timestamp - self._t0) / self.tau_seconds > MAX_WEIGHT_EXPONENT:
+                self._rebase(timestamp)
+            else:
+                stats.weight = math.exp((timestamp - self._t0) / self.tau_seconds)
+                self._sum_weights += stats.weight
+                self._sum_values += stats.weight * value
+        else:
+            # subtracting the dominant weight cancels the sums out, recompute them from the remaining sensors
+            self._rebase(max((x.timestamp for x in self._stats.values() if x.value is not None), default=None))
+
+        fused = self.value()
+        if fused is None or self._reported is None:
+            changed = fused != self._reported
+        else:
+            changed = abs(fused - self._reported) > self.deadband
+        if changed:
+            self._reported = fused
+        return changed
+
+    def _accept(self, stats, value):
+        # rejects jumps far outside the sensor's usual variation, unless they persist
+        if stats.mean is None:
+            stats.mean = value
+            return True
+        delta = abs(value - stats.mean)
+        if delta > max(self.outlier_delta, OUTLIER_DEVIATIONS * stats.deviation):
+            stats.rejected += 1
+            if stats.rejected < OUTLIER_ACCEPT_COUNT:
+                return False
+            stats.mean, stats.deviation, stats.rejected = value, 0., 0
+            return True
+        stats.rejected = 0
+        stats.deviation += SENSOR_EWMA_ALPHA * (delta - stats.deviation)
+        stats.mean += SENSOR_EWMA_ALPHA * (value - stats.mean)
+        return True
+
+    def _rebase(self, t0):
+        self._t0 = t0
+        self._sum_weights = 0.
+        self._sum_values = 0.
+        if t0 is None:
+            return
+        for stats in self._stats.values():
+            if stats.value is None:
+                continue
+            stats.weight = math.exp((stats.timestamp - t0) / self.tau_seconds)
+            self._sum_weights += stats.weight
+            self._sum_values += stats.weight * stats.value
 
 @define
 class RoomThermostat:
@@ -192,12 +529,30 @@ class RoomThermostat:
     manual: bool
     thermostats: list[Thermostat]
     temperature_sensors: list[TemperatureSensor]
+    state_cache: StateCache
+    dispatcher: ClimateDispatcher
+    update_coalesce_seconds: float = field(default=DEFAULT_UPDATE_COALESCE_SECONDS)
+    min_update_interval_seconds: float = field(default=DEFAULT_MIN_UPDATE_INTERVAL_SECONDS)
+    manual_since: Optional[datetime.datetime] = field(default=None)
+    fusion: Optional[TemperatureFusion] = field(default=None)
+    history: Optional[SetpointHistory] = field(default=None)
+    update_stats: dict[str, int] = field(init=False, factory=lambda: {"requested": 0, "merged": 0, "run": 0})
+    _update_handle: Any = field(init=False, default=None)
+    _last_update_time: Optional[datetime.datetime] = field(init=False, default=None)
+    _update_reason: int = field(init=False, default=REASON_SENSOR)
+    _sensor_ids: frozenset[str] = field(init=False)
+    _thermostat_ids: frozenset[str] = field(init=False)
 
     def __attrs_post_init__(self):
-        self.hass.listen_event(self._on_sensor_temperature_changed, TEMPERATURE_SENSOR_UPDATED)
+        self._sensor_ids = frozenset(x.entity_id for x in self.temperature_sensors)
+        self._thermostat_ids = frozenset(x.entity_id for x in self.thermostats)
+        if self.fusion is None:
+            self.fusion = TemperatureFusion(sensors=self.temperature_sensors)
         for t in self.thermostats:
             entity = self.hass.get_entity(t.entity_id)
             entity.listen_state(self._on_thermostat_temperature_changed, attribute="current_temperature")
+            # setpoints changed at the device, so the dispatcher does not take a corrective write for a no-op
+            entity.listen_state(self._on_thermostat_setting_changed, attribute="temperature")
 
         entity = self.hass.get_entity(self.entity)
         entity.listen_state(self._on_target_temperature_changed, attribute="temperature")
@@ -212,84 +567,314 @@ class RoomThermostat:
 
     def set_auto_target_temperature(self, value):
         self.auto_target_temp = value
-        self.hass.log("{} setting auto target temp to {}".format(self.name, self.auto_target_temp), level="DEBUG")
+        log_debug(self.hass, "{} setting auto target temp to {}", self.name, self.auto_target_temp)
 
-    def get_target_temperature(self):
-        return self.hass.get_state(self.entity, attribute="temperature")
+    def get_target_temperature(self, refresh=False):
+        pending = self.dispatcher.pending_temperature(self.entity)
+        if pending is not None:
+            return pending
+        return self.state_cache.get(self.entity, "temperature", refresh=refresh)
 
     def reset_to_auto(self):
-        self.hass.log("{} resetting to auto".format(self.name), level="DEBUG")
+        log_debug(self.hass, "{} resetting to auto", self.name)
         if self.auto_target_temp is not None:
             self._set_target_temperature(self.auto_target_temp)
 
     def measure_temperature(self):
-        temps = list(filter(lambda x: x is not None, [y.last_temperature() for y in self.temperature_sensors]))
-        if len(temps) == 0:
+        temperature = self.fusion.value()
+        if temperature is None:
             self.hass.log(
                 "{}: all (n={}) temperature sensors return no values. Using thermostat temperature.".format(self.name, len(self.temperature_sensors)), 
                 level="WARNING"
             )
-            return self.hass.get_state(self.thermostats[0].entity_id, attribute="current_temperature")
-        elif len(temps) < len(self.temperature_sensors):
-            self.hass.log(
-                "{}: some temperature sensors return no values. Using arbitrary temperature sensor.".format(self.name), 
-                level="WARNING"
-            )
-            return temps[0]
-        else:
-            return sum(temps)/len(temps)
+            return self.thermostats[0].get_measured_temperature()
+        return temperature
 
     def _set_target_temperature(self, value):
-        self.hass.call_service("climate/set_temperature", entity_id=self.entity, temperature=value)
+        self.dispatcher.set_temperature(self.entity, value)
+
+    def _request_update(self, reason):
+        # collapse bursts of sensor/thermostat changes into one update using the latest values
+        self.update_stats["requested"] += 1
+        self._update_reason = reason
+        if self._update_handle is not None:
+            self.update_stats["merged"] += 1
+            return
 
-    def _update_thermostats(self, add_offset_seconds=0, force=False):
-        room_temp = self.measure_temperature()
-        target_temp = self.get_target_temperature()
-        for t in self.thermostats:
-            t.set_temperature(target_temp, room_temp, force=force)
+        delay = self.update_coalesce_seconds
+        if self._last_update_time is not None:
+            elapsed = (self.hass.get_now() - self._last_update_time).total_seconds()
+            delay = max(delay, self.min_update_interval_seconds - elapsed)
+        if delay <= 0:
+            self._update_thermostats(reason=reason)
+        else:
+            self._update_handle = self.hass.run_in(self._on_coalesced_update, delay)
+
+    @timed()
+    def _on_coalesced_update(self, kwargs):
+        self._update_handle = None
+        self._update_thermostats(reason=self._update_reason)
+
+    def _update_thermostats(self, add_offset_seconds=0, force=False, reason=REASON_TARGET):
+        if self._update_handle is not None:
+            # a pending coalesced update is covered by this one
+            self.hass.cancel_timer(self._update_handle)
+            self._update_handle = None
+            self.update_stats["merged"] += 1
+        now = self.hass.get_now()
+        self._last_update_time = now
+        self.update_stats["run"] += 1
 
-    def _on_sensor_temperature_changed(self, event_name, data, kwargs):
-        if data["entity_id"] in [x.entity_id for x in self.temperature_sensors]:
-            self.hass.log("Room {} on_sensor_temperature_changed() updates thermostats", level="DEBUG")
-            self._update_thermostats()
+        room_temp = self.measure_temperature()
+        target_temp = self.get_target_temperature(refresh=force)
+        setpoints = [t.set_temperature(target_temp, room_temp, force=force) for t in self.thermostats]
+        if self.history is not None:
+            self.history.record(now.timestamp(), room_temp, target_temp, reason, setpoints)
+
+    @timed()
+    def on_sensor_temperature_changed(self, entity_id, temperature):
+        if entity_id not in self._sensor_ids:
+            return
+        if self.fusion.update(entity_id):
+            log_debug(self.hass, "Room {} on_sensor_temperature_changed() updates thermostats", self.name)
+            self._request_update(REASON_SENSOR)
 
+    @timed()
     def _on_thermostat_temperature_changed(self, entity, attribute, old, new, kwargs):
-        if entity in [x.entity_id for x in self.thermostats]:
-            self.hass.log("Room {} on_thermostat_temperature_changed() updates thermostats", level="DEBUG")
-            self._update_thermostats()
+        if entity in self._thermostat_ids:
+            self.state_cache.put(entity, "current_temperature", new)
+            log_debug(self.hass, "Room {} on_thermostat_temperature_changed() updates thermostats", self.name)
+            self._request_update(REASON_THERMOSTAT)
+
+    def _on_thermostat_setting_changed(self, entity, attribute, old, new, kwargs):
+        self.state_cache.put(entity, "temperature", new)
 
+    @timed()
     def _on_target_temperature_changed(self, entity, attribute, old, new, kwargs):
         self.hass.log("{} _on_target_temperature_changed. new: {}, old: {}".format(self.name, new, old))
+        self.state_cache.put(self.entity, "temperature", new)
         if new == old:
             return
-        self.manual = new != self.auto_target_temp
+        manual = new != self.auto_target_temp
+        if manual and not self.manual:
+            self.manual_since = self.hass.get_now()
+        self.manual = manual
         self.hass.log("{} manual mode: {}".format(self.name, self.manual))
         self._update_thermostats()
         self._publish_auto_state()
 
     def _on_turn_off(self, entity, attribute, old, new, kwargs):
-        self.hass.log("{} _on_turn_off".format(self.name), level="DEBUG")
+        log_debug(self.hass, "{} _on_turn_off", self.name)
         if new == old:
             return
         if new == "off":
             self.reset_to_auto()
             self.hass.call_service("climate/turn_on", entity_id=self.entity)
 
+    def set_manual(self, value):
+        if value == self.manual:
+            return
+        self.manual = value
+        self.manual_since = self.hass.get_now() if value else None
+        self._publish_auto_state()
+
     def _publish_auto_state(self):
         self.hass.set_state("sensor.{}_manual_mode".format(self.name), state=self.manual)
 
     @classmethod
-    def from_dict(cls, hass, dct, name, auto_target_temp, manual):
+    def from_dict(cls, hass, dct, name, auto_target_temp, manual, state_cache, dispatcher, sensor_factory=None, manual_since=None):
+        if sensor_factory is None:
+            sensor_factory = lambda e: TemperatureSensor.create(hass, e)
+        temperature_sensors = [sensor_factory(e) for e in dct["temperature_sensors"]]
+        fusion = TemperatureFusion(
+            sensors=temperature_sensors,
+            tau_seconds=dct.get("sensor_tau_seconds", DEFAULT_SENSOR_TAU_SECONDS),
+            outlier_delta=dct.get("outlier_delta", DEFAULT_OUTLIER_DELTA),
+            deadband=dct.get("temperature_deadband", DEFAULT_TEMPERATURE_DEADBAND)
+        )
         return cls(
             hass=hass,
             name="room_thermostat_{}".format(name),
             entity=dct["control"],
             auto_target_temp=auto_target_temp,
             manual=manual,
-            thermostats=[Thermostat(hass=hass, **e) for e in dct["thermostats"]],
-            temperature_sensors=[TemperatureSensor.create(hass, e) for e in dct["temperature_sensors"]]
+            thermostats=[Thermostat(hass=hass, state_cache=state_cache, dispatcher=dispatcher, **e) for e in dct["thermostats"]],
+            temperature_sensors=temperature_sensors,
+            state_cache=state_cache,
+            dispatcher=dispatcher,
+            update_coalesce_seconds=dct.get("update_coalesce_seconds", DEFAULT_UPDATE_COALESCE_SECONDS),
+            min_update_interval_seconds=dct.get("min_update_interval_seconds", DEFAULT_MIN_UPDATE_INTERVAL_SECONDS),
+            manual_since=manual_since if manual else None,
+            fusion=fusion
         )
 
+@define
+class HouseController:
+    # one setpoint pass over all thermostats of the house, vectorized when numpy is available
+    hass: hass
+    dispatcher: ClimateDispatcher
+    room_thermostats: list[RoomThermostat]
+    stats: dict[str, int] = field(init=False, factory=lambda: {"runs": 0, "writes": 0})
+    _thermostats: list[Thermostat] = field(init=False, factory=list)
+    _room_index: Any = field(init=False, default=None)
+    _alpha: Any = field(init=False, default=None)
+    _offset: Any = field(init=False, default=None)
+
+    def __attrs_post_init__(self):
+        room_index = []
+        for i, rt in enumerate(self.room_thermostats):
+            for t in rt.thermostats:
+                self._thermostats.append(t)
+                room_index.append(i)
+        if np is not None:
+            self._room_index = np.array(room_index, dtype=np.intp)
+            self._alpha = np.array([t.alpha for t in self._thermostats], dtype=float)
+            self._offset = np.array([t.offset for t in self._thermostats], dtype=float)
+        else:
+            self._room_index = room_index
+
+    @staticmethod
+    def _as_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+
+    def evaluate(self, force=False):
+        room_temperatures = [self._as_float(rt.measure_temperature()) for rt in self.room_thermostats]
+        targets = [self._as_float(rt.get_target_temperature()) for rt in self.room_thermostats]
+        measured = [self._as_float(t.get_measured_temperature()) for t in self._thermostats]
+        commanded = [self._as_float(self.dispatcher.commanded_temperature(t.entity_id)) for t in self._thermostats]
+        if np is not None:
+            changed = self._compute_vectorized(room_temperatures, targets, measured, commanded, force)
+        else:
+            changed = self._compute(room_temperatures, targets, measured, commanded, force)
+
+        self.stats["runs"] += 1
+        rooms = set()
+        for i, temperature in changed:
+            t = self._thermostats[i]
+            if self.dispatcher.set_temperature(t.entity_id, temperature, force=force):
+                self.stats["writes"] += 1
+                rooms.add(self._room_index[i])
+                log_debug(self.hass, "[HouseController] {} setting -> {}", t.entity_id, temperature)
+
+        if len(rooms) > 0:
+            now = self.hass.get_now().timestamp()
+            for k in rooms:
+                rt = self.room_thermostats[k]
+                if rt.history is not None:
+                    setpoints = [self.dispatcher.commanded_temperature(t.entity_id) for t in rt.thermostats]
+                    rt.history.record(now, room_temperatures[k], targets[k], REASON_CONTROLLER, setpoints)
+
+    def _compute_vectorized(self, room_temperatures, targets, measured, commanded, force):
+        room = np.array(room_temperatures)[self._room_index]
+        target = np.array(targets)[self._room_index]
+        measured = np.array(measured)
+        delta = target - room
+        heating = np.minimum(np.maximum(np.round((measured + self._alpha*delta + self._offset)*2.)/2., target), Thermostat.MAX_TEMP_SETTING)
+        setpoints = np.where(delta > 0, heating, Thermostat.MIN_TEMP_SETTING)
+        setpoints[np.isnan(delta)] = np.nan
+
+        valid = ~np.isnan(setpoints)
+        if not force:
+            valid &= setpoints != np.array(commanded)
+        return [(int(i), float(setpoints[i])) for i in np.flatnonzero(valid)]
+
+    def _compute(self, room_temperatures, targets, measured, commanded, force):
+        res = []
+        for i, t in enumerate(self._thermostats):
+            room, target = room_temperatures[self._room_index[i]], targets[self._room_index[i]]
+            if math.isnan(room) or math.isnan(target) or (target > room and math.isnan(measured[i])):
+                continue
+            setpoint = t.compute_setpoint(target, room, measured[i])
+            if not math.isnan(setpoint) and (force or setpoint != commanded[i]):
+                res.append((i, setpoint))
+        return res
+
+@define
+class TransitionScheduler:
+    hass: hass
+    # called once after each batch of transitions
+    on_transitions: Optional[Callable[[], None]] = field(default=None)
+    _queue: list[tuple] = field(init=False, factory=list)
+    _rooms: dict[str, Any] = field(init=False, factory=dict)
+    _generations: dict[str, int] = field(init=False, factory=dict)
+    _sequence: Any = field(init=False, factory=count)
+    _handle: Any = field(init=False, default=None)
+    _handle_time: Optional[datetime.datetime] = field(init=False, default=None)
+
+    def schedule_room(self, room):
+        # bumping the generation invalidates all queued entries of the room
+        generation = self._generations.get(room.name, 0) + 1
+        self._generations[room.name] = generation
+        self._rooms[room.name] = room
+        self._push(room.name, generation, self.hass.get_now())
+        self._arm()
+
+    def _push(self, name, generation, dt):
+        transition = self._rooms[name].get_next_transition(dt)
+        if transition is None:
+            return
+        time, setmode = transition
+        heapq.heappush(self._queue, (time, next(self._sequence), name, generation, setmode))
+
+    def _is_stale(self, entry):
+        return entry[3] != self._generations.get(entry[2])
+
+    def _arm(self):
+        while len(self._queue) > 0 and self._is_stale(self._queue[0]):
+            heapq.heappop(self._queue)
+
+        time = self._queue[0][0] if len(self._queue) > 0 else None
+        if time == self._handle_time:
+            return
+        if self._handle is not None:
+            self.hass.cancel_timer(self._handle)
+            self._handle = None
+        self._handle_time = time
+        if time is not None:
+            self._handle = self.hass.run_at(self._on_timer, time)
+
+    @timed()
+    def _on_timer(self, kwargs):
+        self._handle = None
+        self._handle_time = None
+        now = self.hass.get_now()
+        transitions = 0
+        while len(self._queue) > 0 and self._queue[0][0] <= now:
+            entry = heapq.heappop(self._queue)
+            if self._is_stale(entry):
+                continue
+            time, _, name, generation, setmode = entry
+            self._rooms[name].on_transition(setmode)
+            # from the clock, not the previous entry, which carries the UTC offset of its day
+            self._push(name, generation, now)
+            transitions += 1
+        self._arm()
+        if transitions > 0 and self.on_transitions is not None:
+            self.on_transitions()
+
+@lru_cache(maxsize=None)
+def build_timeline(compiled, modes):
+    # (timeline, switch times, published timeline attribute), shared by rooms with the same schedule and modes
+    temperatures = dict(modes)
+    timeline = []
+    for t, mode in zip(compiled.transition_times, compiled.transition_modes):
+        # the week wraps around, so the last switch is still in effect before the first one
+        previous = timeline[-1][1] if len(timeline) > 0 else None
+        if mode != previous:
+            timeline.append((t, mode, temperatures[mode]))
+    while len(timeline) > 1 and timeline[0][1] == timeline[-1][1]:
+        timeline.pop(0)
+    if len(timeline) == 1 and timeline[0][1] == DEFAULT_SETMODE:
+        timeline = []
+    published = [
+        {"weekday": t // SECONDS_PER_DAY + 1, "time": str(datetime.timedelta(seconds=t % SECONDS_PER_DAY)), "mode": mode, "temperature": temp}
+        for t, mode, temp in timeline
+    ]
+    return (tuple(timeline), tuple(x[0] for x in timeline), published)
+
 @define
 class Room:
     hass: hass
@@ -297,15 +882,26 @@ class Room:
     room_thermostat: RoomThermostat
     modes: dict[str, float]    
     default_schedule: Schedule
-    handles: list[Any] = field(default=[])
-    conditionals: list[Any] = field(default=[])
+    transition_scheduler: TransitionScheduler
+    conditionals: list[Any] = field(factory=list)
     default_mode: str = field(default="eco")
+    # entity_id -> last known state of the conditional entities
+    conditional_states: dict[str, Any] = field(factory=dict)
     _current_schedule: Schedule = field(init=False)
+    # (second of week, mode, target temperature) at every mode switch of the active schedule
+    _timeline: tuple[tuple[int, str, float], ...] = field(init=False, default=())
+    _timeline_times: tuple[int, ...] = field(init=False, default=())
+    _published_next: Optional[tuple] = field(init=False, default=None)
 
     def __attrs_post_init__(self):
         self._current_schedule = self.default_schedule
+        # highest priority first, equal priorities in declaration order
+        self.conditionals = sorted(self.conditionals, key=lambda c: -c.get("priority", 0))
+        for c in self.conditionals:
+            if c["entity_id"] not in self.conditional_states:
+                self.conditional_states[c["entity_id"]] = self.hass.get_state(c["entity_id"])
 
-        self._update_schedule(force=True)
+        self._update_schedule(force=True, keep_manual=True)
 
         self.hass.log("==================== ")
         self.hass.log("Room {} initialized:".format(self.name))
@@ -319,6 +915,10 @@ class Room:
 
     def update_ha_sensor_state(self):
         res = self.get_next_state()
+        published = (res["next-target-temperature"], res["next-time"], res["next-mode"])
+        if published == self._published_next:
+            return
+        self._published_next = published
         self.hass.set_state(
             "sensor.room_thermostat_{}_next_temperature".format(self.name), 
             state=res["next-target-temperature"], 
@@ -326,111 +926,109 @@ class Room:
             next_mode=res["next-mode"]
         )
 
+    def _build_timeline(self):
+        self._timeline, self._timeline_times, published = build_timeline(self._current_schedule.compiled, tuple(sorted(self.modes.items())))
+        self.hass.set_state(
+            "sensor.room_thermostat_{}_timeline".format(self.name),
+            state=self._current_schedule.name,
+            timeline=published
+        )
+
+    def _state_at(self, dt):
+        if len(self._timeline) == 0:
+            return (DEFAULT_SETMODE, self.modes[DEFAULT_SETMODE])
+        idx = bisect_right(self._timeline_times, seconds_of_week(dt.isoweekday(), dt.time())) - 1
+        _, mode, temp = self._timeline[idx]
+        return (mode, temp)
+
     def get_room_temperature(self):
         return self.room_thermostat.measure_temperature()
 
     def current_state(self, add_offset_seconds=0):
-        scheduled = self._current_schedule.get_item_at_datetime(
-            self.hass.get_now() + datetime.timedelta(seconds=add_offset_seconds)
-        )
-        mode = scheduled.setmode if scheduled is not None else DEFAULT_SETMODE
-        temp = self.modes[mode]
+        mode, temp = self._state_at(self.hass.get_now() + datetime.timedelta(seconds=add_offset_seconds))
         return {"mode": mode, "target-temperature": temp}
 
-    def get_next_state(self):
-        next_item, date = self._current_schedule.get_next_item_at_datetime(self.hass.get_now())
-
-        # mode
-        if next_item is None or next_item[0] == "current":
-            mode = DEFAULT_SETMODE
-        else:
-            mode = next_item[1].setmode
-
-        # temperature
-        temp = self.modes[mode]
-
-        # next time switch
-        if next_item is None:
-            time = None
-        else:
-            if next_item[0] == "current":
-                time = next_item[1].end
-            else:
-                time = next_item[1].start
+    def get_next_transitions(self, n, dt=None):
+        dt = (dt if dt is not None else self.hass.get_now()).replace(microsecond=0)
+        if len(self._timeline) == 0:
+            return []
+        t = seconds_of_week(dt.isoweekday(), dt.time())
+        idx = bisect_right(self._timeline_times, t)
+        monday = dt.date() - datetime.timedelta(days=dt.isoweekday() - 1)
+        res = []
+        for k in range(n):
+            week, i = divmod(idx + k, len(self._timeline))
+            switch, mode, temp = self._timeline[i]
+            res.append({"time": local_datetime(dt.tzinfo, monday, switch + week * SECONDS_PER_WEEK), "mode": mode, "target-temperature": temp})
+        return res
 
-        return {"next-time": datetime.datetime.combine(date,time), "next-mode": mode, "next-target-temperature": temp}
+    def get_next_state(self):
+        res = self.get_next_transitions(1)
+        if len(res) == 0:
+            return {"next-time": None, "next-mode": DEFAULT_SETMODE, "next-target-temperature": self.modes[DEFAULT_SETMODE]}
+        return {"next-time": res[0]["time"], "next-mode": res[0]["mode"], "next-target-temperature": res[0]["target-temperature"]}
 
-    def set_target_temperature_from_schedule(self, add_offset_seconds=0, kwargs=None):
+    def set_target_temperature_from_schedule(self, add_offset_seconds=0, kwargs=None, keep_manual=False):
         sched_temperature = self.current_state(add_offset_seconds=add_offset_seconds)["target-temperature"]
         self.hass.log("Room {} target temp set: {}".format(self.name, sched_temperature))
         self.room_thermostat.set_auto_target_temperature(sched_temperature)
-        self.room_thermostat.reset_to_auto()
+        if keep_manual and self._keeps_manual():
+            self.hass.log("Room {} stays in manual mode".format(self.name))
+        else:
+            if keep_manual:
+                self.room_thermostat.set_manual(False)
+            self.room_thermostat.reset_to_auto()
         self.update_ha_sensor_state()
 
+    def _keeps_manual(self):
+        # a manual setpoint restored from a snapshot lasts until the next scheduled switch after it was made
+        if not self.room_thermostat.manual or self.room_thermostat.manual_since is None:
+            return False
+        res = self.get_next_transitions(1, self.room_thermostat.manual_since)
+        return len(res) == 0 or res[0]["time"] > self.hass.get_now()
+
     def conditional_has_changed(self, entity, attribute, old, new, kwargs):
-        if entity not in self.conditionals and new == old:
+        if entity not in self.conditional_states or self.conditional_states[entity] == new:
             return
+        self.conditional_states[entity] = new
         self._update_schedule()
 
-    def _update_schedule(self, force=False):
-        c_schedule = None
-        # determine if default or conditional schedule should be used
-        c_states = []
+    def _select_schedule(self):
+        # the first matching conditional wins, conditionals are ordered by priority
         for c in self.conditionals:
-            state = self.hass.get_state(c["entity_id"])
+            state = self.conditional_states.get(c["entity_id"])
             if state in c["values"]:
-                c_states.append({"entity_id": c["entity_id"], "state": state, "schedule": c["values"][state]})
-
-        # assume only one element for now
-        if len(c_states) > 0:
-            c_schedule = c_states[0]["schedule"]
+                return c["values"][state]
+        return self.default_schedule
 
-        c_schedule = c_schedule if c_schedule is not None else self.default_schedule
-        if c_schedule != self._current_schedule or force:
+    def _update_schedule(self, force=False, keep_manual=False):
+        c_schedule = self._select_schedule()
+        if c_schedule is not self._current_schedule or force:
             self._current_schedule = c_schedule
-            self._cancel_scheduled_events()
+            self._build_timeline()
             self._schedule_events()
-            self.set_target_temperature_from_schedule()
+            self.set_target_temperature_from_schedule(keep_manual=keep_manual)
             return True
         return False
 
-    def _cancel_scheduled_events(self):
-        self.hass.log("Cancelling schedule for room {}".format(self.name), level="DEBUG")
-        for handle in self.handles:
-            self.hass.cancel_timer(handle)
-        self.handles = []
-
     def _schedule_events(self):
-        self.hass.log("Room {}: scheduling events for schedule {}".format(self.name, self._current_schedule.name), level="DEBUG")
-        for item in self._current_schedule.items:
-            self.handles.append(
-                self.hass.run_daily(
-                    self._set_mode_callback, 
-                    item.start, 
-                    setmode=item.setmode, 
-                    constrain_days=weekday_str_from_list(item.weekdays)
-                )
-            )
-            self.handles.append(
-                self.hass.run_daily(
-                    self._set_mode_callback, 
-                    item.end, 
-                    setmode=DEFAULT_SETMODE,
-                    constrain_days=weekday_str_from_list(item.weekdays)
-                )
-            )
+        log_debug(self.hass, "Room {}: scheduling events for schedule {}", self.name, self._current_schedule.name)
+        self.transition_scheduler.schedule_room(self)
+
+    def get_next_transition(self, dt):
+        res = self.get_next_transitions(1, dt)
+        if len(res) == 0:
+            return None
+        return (res[0]["time"], res[0]["mode"])
 
-    def _set_mode_callback(self, kwargs):
-        self.hass.log("Room {}: mode changed to {}".format(str(self.name), kwargs["setmode"]))
+    @timed()
+    def on_transition(self, setmode):
+        self.hass.log("Room {}: mode changed to {}".format(str(self.name), setmode))
         self.set_target_temperature_from_schedule(add_offset_seconds=10)
 
     @classmethod
     def replace_conditional_schedules(cls, conditionals, schedules):
-        res = copy.deepcopy(conditionals)
-        for i in res:
-            for k,v in i["values"].items():
-                i["values"][k] = schedules[v]
-        return res
+        return [{**c, "values": {k: schedules[v] for k,v in c["values"].items()}} for c in conditionals]
 
     @classmethod
     def merge_modes(cls, default_modes, custom_modes):
@@ -440,7 +1038,7 @@ class Room:
         return modes
 
     @classmethod
-    def from_dict(cls, hass, name, dct, default_modes, schedules):
+    def from_dict(cls, hass, name, dct, default_modes, schedules, transition_scheduler, state_cache, dispatcher, sensor_factory=None, conditional_states=None, manual_since=None):
         conditionals = dct.get("conditional_schedules") or []
         conditionals = cls.replace_conditional_schedules(conditionals, schedules)
         custom_modes = cls.merge_modes(default_modes, dct.get("modes") or {})
@@ -449,35 +1047,236 @@ class Room:
         return cls(
             hass=hass,
             name=name,
-            room_thermostat=RoomThermostat.from_dict(hass, dct, name=name, auto_target_temp=auto_target_temp, manual=False),
+            room_thermostat=RoomThermostat.from_dict(hass, dct, name=name, auto_target_temp=auto_target_temp, manual=manual_since is not None, state_cache=state_cache, dispatcher=dispatcher, sensor_factory=sensor_factory, manual_since=manual_since),
             default_schedule=schedules[dct["default_schedule"]],
+            transition_scheduler=transition_scheduler,
             modes=custom_modes,
-            conditionals=conditionals
+            conditionals=conditionals,
+            conditional_states={c["entity_id"]: conditional_states[c["entity_id"]] for c in conditionals if c["entity_id"] in (conditional_states or {})}
         )
 
-class SmartHeating(hass.Hass):
+class SmartHeating(MetricsMixin, hass.Hass):
+    dispatcher_class = ClimateDispatcher
+
     def initialize(self):
         self.log("SmartHeating started")
         self.schedules = {}
         self.rooms = {}
         self.default_modes = self.args["default_modes"]
         self.reset_handle = None
-
-        conditionals = []
-        for k,v in self.args["schedules"].items():
-            s = Schedule.from_list(k, v)
-            self.schedules[s.name] = s
+        self.transition_scheduler = TransitionScheduler(hass=self)
+        self.state_cache = StateCache(hass=self, max_age_seconds=self.args.get("state_cache_max_age_seconds", DEFAULT_STATE_CACHE_MAX_AGE_SECONDS))
+        self.dispatcher = self.dispatcher_class(hass=self, state_cache=self.state_cache, max_calls_per_second=self.args.get("max_service_calls_per_second", DEFAULT_MAX_SERVICE_CALLS_PER_SECOND))
+        self.temperature_sensors = {}
+        self._sensor_rooms = {}
+        self._conditional_rooms = {}
+
+        # warm start: cached climate states, sensor values and manual rooms from the last run
+        self.snapshot_path = self.args.get("snapshot_path") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "{}_snapshot.json".format(self.name))
+        self.config_hash = self._config_hash()
+        snapshot = self._load_snapshot()
+        self.state_cache.load(snapshot.get("state_cache", []))
+        self._initial_sensors = self._fresh_sensor_values(snapshot.get("sensors", {}))
+        manual_rooms = snapshot.get("manual_rooms", {})
+
+        # app wide defaults, overridable per room
+        room_defaults = {k: self.args[k] for k in ("update_coalesce_seconds", "min_update_interval_seconds", "sensor_tau_seconds", "outlier_delta", "temperature_deadband") if k in self.args}
+
+        self.schedules = shared_schedules(self.args["schedules"])
+
+        # read every conditional entity once, rooms keep their own copy up to date from the callbacks
+        conditional_states = {}
+        for v in self.args["rooms"].values():
+            for c in v.get("conditional_schedules") or []:
+                if c["entity_id"] not in conditional_states:
+                    conditional_states[c["entity_id"]] = self.get_state(c["entity_id"])
+
+        conditional_rooms = {}
         for k,v in self.args["rooms"].items():
-            r = Room.from_dict(self, k, v, self.default_modes, self.schedules)
+            manual_since = datetime.datetime.fromisoformat(manual_rooms[k]) if k in manual_rooms else None
+            r = Room.from_dict(self, k, {**room_defaults, **v}, self.default_modes, self.schedules, self.transition_scheduler, self.state_cache, self.dispatcher, self._get_temperature_sensor, conditional_states, manual_since)
             self.rooms[r.name] = r
-            conditionals.extend([x["entity_id"] for x in r.conditionals])
+            for entity_id in r.conditional_states:
+                conditional_rooms.setdefault(entity_id, []).append(r)
+        self._conditional_rooms = {k: tuple(v) for k,v in conditional_rooms.items()}
 
-        for i in set(conditionals):
+        # sensor -> owning rooms, so sensor updates are only delivered where needed
+        sensor_rooms = {}
+        for r in self.rooms.values():
+            for sensor in r.room_thermostat.temperature_sensors:
+                sensor_rooms.setdefault(sensor.entity_id, []).append(r.room_thermostat)
+        self._sensor_rooms = {k: tuple(v) for k,v in sensor_rooms.items()}
+
+        # setpoint decisions per room, flushed to a compressed append-only log
+        self.history_log = None
+        history_interval = self.args.get("history_flush_interval_seconds", DEFAULT_HISTORY_FLUSH_SECONDS)
+        if history_interval:
+            history_path = self.args.get("history_path") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "{}_history.gz".format(self.name))
+            self.history_log = HistoryLog(path=history_path, size=self.args.get("history_size", DEFAULT_HISTORY_SIZE))
+            for r in self.rooms.values():
+                r.room_thermostat.history = self.history_log.ring(r.name, [t.entity_id for t in r.room_thermostat.thermostats])
+            self.run_every(self.flush_history, "now+{}".format(history_interval), history_interval)
+
+        self.controller = None
+        if self.args.get("house_controller", True):
+            self.controller = HouseController(hass=self, dispatcher=self.dispatcher, room_thermostats=[r.room_thermostat for r in self.rooms.values()])
+            self.transition_scheduler.on_transitions = self.controller.evaluate
+            self.log("House controller {}".format("vectorized with numpy" if np is not None else "without numpy, evaluating thermostats one by one"))
+            controller_interval = self.args.get("controller_interval_seconds", DEFAULT_CONTROLLER_INTERVAL_SECONDS)
+            if controller_interval:
+                self.run_every(self.reevaluate, "now+{}".format(controller_interval), controller_interval)
+
+        for i in self._conditional_rooms:
             self.log("App subscribing to {}".format(i))
             entity = self.get_entity(i)
             entity.listen_state(self.on_conditional_changed)
 
+        self.published_update_stats = None
+        self.run_every(self.publish_update_stats, "now", self.args.get("stats_interval_seconds", DEFAULT_STATS_INTERVAL_SECONDS))
+        snapshot_interval = self.args.get("snapshot_interval_seconds", DEFAULT_SNAPSHOT_INTERVAL_SECONDS)
+        if snapshot_interval:
+            self.run_every(self.save_snapshot, "now+{}".format(snapshot_interval), snapshot_interval)
+        self.start_metrics()
+
+    @timed()
+    def reevaluate(self, kwargs):
+        self.controller.evaluate()
+
+    def terminate(self):
+        self.save_snapshot({})
+        if self.history_log is not None:
+            self.flush_history({})
+
+    @timed()
+    def flush_history(self, kwargs):
+        self.history_log.flush(self.get_now().tzinfo)
+
+    def _config_hash(self):
+        config = {k: self.args.get(k) for k in ("default_modes", "schedules", "rooms")}
+        return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            return {}
+        if snapshot.get("config_hash") != self.config_hash:
+            # rooms or schedules changed, manual overrides refer to the old configuration
+            snapshot.pop("manual_rooms", None)
+        self.log("Warm start from snapshot saved at {}".format(snapshot.get("saved_at")))
+        return snapshot
+
+    def _fresh_sensor_values(self, sensors):
+        max_age = self.args.get("snapshot_max_age_seconds", DEFAULT_SNAPSHOT_MAX_AGE_SECONDS)
+        now = self.get_now()
+        res = {}
+        for entity_id, (value, time) in sensors.items():
+            time = datetime.datetime.fromisoformat(time)
+            if (now - time).total_seconds() <= max_age:
+                res[entity_id] = (value, time)
+        return res
+
+    def save_snapshot(self, kwargs):
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": self.get_now().isoformat(),
+            "config_hash": self.config_hash,
+            "state_cache": self.state_cache.dump(),
+            "sensors": {k: [v.last_value, v.last_value_time.isoformat()] for k,v in self.temperature_sensors.items()},
+            "manual_rooms": {r.name: r.room_thermostat.manual_since.isoformat() for r in self.rooms.values() if r.room_thermostat.manual and r.room_thermostat.manual_since is not None},
+        }
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.snapshot_path)
+
+    def _get_temperature_sensor(self, entity_id):
+        # rooms sharing a sensor share one instance and one state listener
+        if entity_id not in self.temperature_sensors:
+            self.temperature_sensors[entity_id] = TemperatureSensor.create(self, entity_id, on_update=self.on_temperature_sensor_updated, initial=self._initial_sensors.get(entity_id))
+        return self.temperature_sensors[entity_id]
+
+    def on_temperature_sensor_updated(self, entity_id, temperature):
+        for rt in self._sensor_rooms.get(entity_id, ()):
+            rt.on_sensor_temperature_changed(entity_id, temperature)
+
+    def publish_update_stats(self, kwargs):
+        rooms = {r.name: dict(r.room_thermostat.update_stats) for r in self.rooms.values()}
+        stats = dict(
+            state=sum(x["merged"] for x in rooms.values()),
+            requested=sum(x["requested"] for x in rooms.values()),
+            run=sum(x["run"] for x in rooms.values()),
+            rooms=rooms,
+            dispatch=dict(self.dispatcher.stats),
+            controller=dict(self.controller.stats) if self.controller is not None else None,
+            history=dict(self.history_log.stats, dropped=self.history_log.dropped()) if self.history_log is not None else None,
+            saved_writes=self.dispatcher.saved_writes()
+        )
+        if stats == self.published_update_stats:
+            return
+        self.published_update_stats = stats
+        self.set_state("sensor.{}_update_stats".format(self.name), **stats)
+
+    @timed()
     def on_conditional_changed(self, entity, attribute, old, new, kwargs):
         self.log("condition {} changed from {} to {}".format(entity, old, new))
-        for r in self.rooms.values():
-            r.conditional_has_changed(entity, attribute, old, new, kwargs)
\ No newline at end of file
+        for r in self._conditional_rooms.get(entity, ()):
+            r.conditional_has_changed(entity, attribute, old, new, kwargs)
+
+class SmartHeatingShard(SmartHeating):
+    # runs a subset of the rooms of another (disabled) SmartHeating app config, sharing its parsed schedules
+    def initialize(self):
+        base = self.app_config[self.args["config"]].args
+        args = {k: v for k,v in base.items() if k not in APPDAEMON_APP_KEYS + ("rooms",)}
+        args.update({k: v for k,v in self.args.items() if k not in APPDAEMON_APP_KEYS + ("config", "rooms")})
+        args["rooms"] = {k: base["rooms"][k] for k in self.args["rooms"]}
+        self.args = args
+        super().initialize()
+
+class SmartHeatingCoordinator(MetricsMixin, hass.Hass):
+    # aggregates the status sensors of the shards into sensor.<name>_status
+    def initialize(self):
+        self.shards = {}
+        self.status = None
+        for shard in self.args["shards"]:
+            self.shards[shard] = {"stats": None, "metrics": None}
+            self.listen_state(self.on_shard_changed, "sensor.{}_update_stats".format(shard), attribute="all", shard=shard, kind="stats")
+            self.listen_state(self.on_shard_changed, "sensor.{}_metrics".format(shard), attribute="all", shard=shard, kind="metrics")
+            self.shards[shard]["stats"] = (self.get_state("sensor.{}_update_stats".format(shard), attribute="all") or {}).get("attributes")
+            self.shards[shard]["metrics"] = (self.get_state("sensor.{}_metrics".format(shard), attribute="all") or {}).get("attributes")
+        self._publish()
+        self.start_metrics()
+
+    @timed()
+    def on_shard_changed(self, entity, attribute, old, new, kwargs):
+        self.shards[kwargs["shard"]][kwargs["kind"]] = (new or {}).get("attributes")
+        self._publish()
+
+    def _publish(self):
+        shards = {}
+        for name, shard in self.shards.items():
+            stats = shard["stats"] or {}
+            callbacks = (shard["metrics"] or {}).get("callbacks") or {}
+            shards[name] = {
+                "rooms": len(stats.get("rooms") or {}),
+                "updates": stats.get("run"),
+                "saved_writes": stats.get("saved_writes"),
+                "max_p95_ms": max((x["p95_ms"] for x in callbacks.values()), default=None),
+            }
+        status = {
+            "shards": shards,
+            "rooms": sum(x["rooms"] for x in shards.values()),
+            "updates": sum(x["updates"] or 0 for x in shards.values()),
+            "saved_writes": sum(x["saved_writes"] or 0 for x in shards.values()),
+        }
+        if status == self.status:
+            return
+        self.status = status
+        self.set_state(
+            "sensor.{}_status".format(self.name),
+            state=sum(1 for x in self.shards.values() if x["stats"] is not None),
+            **status
+        )
@@ -0,0 +1,30 @@
+import asyncio
+from attrs import define
+from app_metrics import timed
+from smart_heating import ClimateDispatcher, SmartHeating
+
+@define
+class AsyncClimateDispatcher(ClimateDispatcher):
+    # sends each batch of setpoints from the event loop, all service calls of a batch concurrently
+
+    @timed()
+    async def _flush(self, kwargs):
+        batch = self._take_batch()
+        attempted = 0
+        try:
+            results = await asyncio.gather(*[self.hass.call_service("climate/set_temperature", entity_id=e, temperature=t) for e, t in batch], return_exceptions=True)
+            attempted = len(batch)
+            now = await self.hass.get_now()
+            for (entity_id, temperature), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.hass.log("Setting {} to {} failed: {}".format(entity_id, temperature, result), level="WARNING")
+                    continue
+                self.state_cache.put(entity_id, "temperature", temperature, now)
+                self.stats["sent"] += 1
+        finally:
+            self._finish_batch(batch, attempted)
+            if self._more_pending():
+                await self.hass.run_in(self._flush, 1)
+
+class SmartHeatingAsync(SmartHeating):
+    dispatcher_class = AsyncClimateDispatcher
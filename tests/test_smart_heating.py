@@ -0,0 +1,142 @@
+import datetime
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import fake_hass
+import replay
+import smart_heating as sh
+from app_metrics import MetricsMixin
+
+
+def test_weekdays_list_and_ranges():
+    assert sh.ScheduleItem._parse_weekdays("1-3,5") == 0b0010111
+    assert sh.ScheduleItem._parse_weekdays("6-7,1") == 0b1100001
+    assert sh.ScheduleItem._parse_weekdays("4") == 0b0001000
+
+
+@pytest.mark.parametrize("weekdays", ["7-1", "1-3,5-4"])
+def test_weekdays_reversed_range(weekdays):
+    with pytest.raises(ValueError, match="reversed weekday range"):
+        sh.ScheduleItem._parse_weekdays(weekdays)
+
+
+def test_weekdays_out_of_range():
+    with pytest.raises(ValueError, match="invalid weekday 8"):
+        sh.ScheduleItem._parse_weekdays("6-8")
+
+
+def test_item_over_midnight_splits_into_next_day():
+    schedule = sh.Schedule.from_list("night", [{"start": "22:00", "end": "06:00", "setmode": "comfort", "weekdays": "7"}])
+    sunday = sh.seconds_of_week(7, datetime.time(22))
+    monday = sh.seconds_of_week(1, datetime.time(6))
+    # the week starts inside the item, at monday 00:00
+    assert schedule.compiled.transition_times == (0, monday, sunday)
+    assert schedule.compiled.transition_modes == ("comfort", sh.DEFAULT_SETMODE, "comfort")
+
+
+def test_overlap_over_midnight():
+    items = [
+        {"start": "22:00", "end": "06:00", "setmode": "comfort", "weekdays": "1"},
+        {"start": "05:00", "end": "08:00", "setmode": "comfort", "weekdays": "2"},
+    ]
+    with pytest.raises(ValueError, match="overlap on weekday 2"):
+        sh.Schedule.from_list("overlap", items)
+
+
+def test_overlap_over_end_of_week():
+    items = [
+        {"start": "23:00", "end": "01:00", "setmode": "comfort", "weekdays": "7"},
+        {"start": "00:30", "end": "08:00", "setmode": "comfort", "weekdays": "1"},
+    ]
+    with pytest.raises(ValueError, match="overlap on weekday 1"):
+        sh.Schedule.from_list("overlap", items)
+
+
+def test_empty_item():
+    with pytest.raises(ValueError, match="is empty"):
+        sh.Schedule.from_list("empty", [{"start": "06:00", "end": "06:00", "setmode": "comfort"}])
+
+
+T0 = datetime.datetime(2024, 1, 8, tzinfo=datetime.timezone.utc)
+
+
+def reading(entity_id, value, minutes):
+    return SimpleNamespace(entity_id=entity_id, last_value=value, last_value_time=T0 + datetime.timedelta(minutes=minutes))
+
+
+def test_fusion_sensor_drops_out():
+    # the fresh sensor's weight dominates the sums, removing it must not leave them cancelled out
+    a = reading("a", 20.0, 0)
+    b = reading("b", 22.0, 0)
+    fusion = sh.TemperatureFusion(sensors=[a, b])
+    for k in range(1, 81):
+        a.last_value, a.last_value_time = 20.0 + (k % 3) * 0.1, T0 + datetime.timedelta(minutes=30 * k)
+        fusion.update("a")
+    assert fusion.value() == pytest.approx(20.2)
+
+    a.last_value = None
+    fusion.update("a")
+    assert fusion.value() == pytest.approx(22.0)
+
+    a.last_value, a.last_value_time = 21.0, T0 + datetime.timedelta(hours=41)
+    fusion.update("a")
+    assert fusion.value() == pytest.approx(21.0)
+
+
+def test_fusion_all_sensors_drop_out():
+    a = reading("a", 20.0, 0)
+    fusion = sh.TemperatureFusion(sensors=[a])
+    a.last_value = None
+    fusion.update("a")
+    assert fusion.value() is None
+
+
+class App(MetricsMixin, fake_hass.Hass):
+    pass
+
+
+def test_steady_sensor_stays_fresh():
+    # a sensor repeating its value keeps its weight against one that went silent
+    world = fake_hass.World(T0)
+    world.add_entity("sensor.a", "20.0")
+    world.add_entity("sensor.b", "20.0")
+    app = App(world, "test", {})
+    fusion = None
+    sensors = [sh.TemperatureSensor.create(app, e, on_update=lambda e, v: fusion.update(e)) for e in ("sensor.a", "sensor.b")]
+    fusion = sh.TemperatureFusion(sensors=sensors)
+    world.inject(T0 + datetime.timedelta(minutes=10), "sensor.b", state="21.0")
+    for k in range(1, 48):
+        world.inject(T0 + datetime.timedelta(minutes=30 * k), "sensor.a", state="20.0", attributes={"seq": k})
+    world.run_for(86400)
+    assert sensors[0].last_value_time == T0 + datetime.timedelta(hours=23, minutes=30)
+    assert fusion.value() == pytest.approx(20.0, abs=0.01)
+
+
+@pytest.fixture
+def room(tmp_path):
+    args = replay.synthetic_config(1, 1, 1, 0)
+    args["schedules"]["schedule_main"] = [{"start": "06:00", "end": "22:30", "setmode": "comfort"}]
+    args["snapshot_path"] = str(tmp_path / "snapshot.json")
+    args["history_path"] = str(tmp_path / "history.gz")
+    world = fake_hass.World(replay.DEFAULT_START)
+    world.app_config = {"smart_heating": args}
+    replay.populate_world(world, args, random.Random(1))
+    app = sh.SmartHeating(world, "smart_heating", args)
+    world.invoke(app, app.initialize, ())
+    return app.rooms["room0"]
+
+
+@pytest.mark.parametrize("day,before,after", [
+    # spring forward, the morning after is +02:00
+    (datetime.datetime(2024, 3, 30, 20), "2024-03-30T22:30:00+01:00", "2024-03-31T06:00:00+02:00"),
+    # fall back, the morning after is +01:00
+    (datetime.datetime(2024, 10, 26, 20), "2024-10-26T22:30:00+02:00", "2024-10-27T06:00:00+01:00"),
+])
+def test_transitions_over_dst_switch(room, day, before, after):
+    pytz = pytest.importorskip("pytz")
+    dt = pytz.timezone("Europe/Berlin").localize(day)
+    transitions = room.get_next_transitions(2, dt)
+    assert [x["time"].isoformat() for x in transitions] == [before, after]
+    assert [x["mode"] for x in transitions] == [sh.DEFAULT_SETMODE, "comfort"]
@@ -0,0 +1,465 @@
+"""In-process stand-in for AppDaemon's ``hassapi`` with a virtual clock.
+
+``install()`` registers this module as ``hassapi`` so the apps in ``apps/`` can be
+imported and run unchanged, without Home Assistant or AppDaemon. All apps share
+one ``World`` holding entity states, listeners and timers. Callbacks are queued
+and delivered in virtual time order, like AppDaemon's worker threads would, and
+every delivery is timed so replay runs can report latencies.
+
+Like AppDaemon, ``async def`` callbacks run on an event loop and API calls made
+from inside it return futures to be awaited. ``World.io_latency`` adds a wall
+clock delay to every Home Assistant round trip, slept in sync callbacks and
+awaited in async ones, so both variants of an app can be compared.
+"""
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import sys
+import time as _time
+from collections import Counter, defaultdict
+from functools import wraps
+
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+
+def install():
+    sys.modules["hassapi"] = sys.modules[__name__]
+
+
+def _in_loop():
+    # the non raising variant, this runs on every API call
+    return asyncio._get_running_loop() is not None
+
+
+async def _completed(result, latency):
+    if latency > 0:
+        await asyncio.sleep(latency)
+    return result
+
+
+def api(io=False):
+    # AppDaemon's sync_wrapper: a plain call from worker threads, a future inside the event loop
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            result = f(self, *args, **kwargs)
+            latency = self._world.io_latency if io else 0
+            if _in_loop():
+                return asyncio.ensure_future(_completed(result, latency))
+            if latency > 0:
+                _time.sleep(latency)
+            return result
+        return wrapper
+    return decorator
+
+
+def callback_name(cb):
+    name = getattr(cb, "__qualname__", None)
+    return name if name is not None else repr(cb)
+
+
+class World:
+    def __init__(self, start, record_history=False):
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=datetime.timezone.utc)
+        self.now = start
+        self.states = {}
+        self.apps = []
+        # apps.yaml contents, exposed to apps as `app_config`
+        self.app_config = {}
+        self.record_history = record_history
+        self.history = defaultdict(list)
+        self.stats = Counter()
+        self.services = Counter()
+        self.latencies = defaultdict(list)
+        self.log_levels = Counter()
+        self.max_live_timers = 0
+        self.echo_logs = False
+        self.log_level = logging.INFO
+        # seconds of wall clock delay per Home Assistant round trip
+        self.io_latency = 0.0
+        self._loop = None
+        self._queue = []
+        self._seq = itertools.count()
+        self._timers = {}
+        self._state_listeners = {}
+        self._event_listeners = {}
+        self._handles = itertools.count(1)
+
+    # -- states
+
+    def add_entity(self, entity_id, state, attributes=None):
+        self._write_state(entity_id, state, attributes or {}, replace=True)
+
+    def inject(self, at, entity_id, state=None, attributes=None):
+        # an external state change (sensor reading, device report) at virtual time `at`
+        self._push(at, ("inject", entity_id, state, attributes or {}))
+        self.stats["injected"] += 1
+
+    def _write_state(self, entity_id, state, attributes, replace=False):
+        now = self.now.isoformat()
+        old = self.states.get(entity_id)
+        if old is None:
+            new = {"entity_id": entity_id, "state": state, "attributes": dict(attributes), "last_changed": now, "last_updated": now}
+        else:
+            new_attributes = dict(attributes) if replace else {**old["attributes"], **attributes}
+            new_state = old["state"] if state is None else state
+            new = {
+                "entity_id": entity_id,
+                "state": new_state,
+                "attributes": new_attributes,
+                "last_changed": now if new_state != old["state"] else old["last_changed"],
+                "last_updated": now,
+            }
+        self.states[entity_id] = new
+        if self.record_history and (old is None or old["state"] != new["state"]):
+            self.history[entity_id].append({"entity_id": entity_id, "state": new["state"], "last_changed": new["last_changed"]})
+        if old is not None:
+            self._notify_state(entity_id, old, new)
+        return new
+
+    def _notify_state(self, entity_id, old, new):
+        # listeners are indexed by entity id, domain or None (everything)
+        listeners = []
+        for key in (entity_id, entity_id.split(".", 1)[0], None):
+            listeners.extend(self._state_listeners.get(key, {}).values())
+        for app, cb, entity, attribute, kwargs in listeners:
+            if attribute == "all":
+                if old != new:
+                    self._deliver(app, cb, (entity_id, "all", old, new, kwargs))
+            elif attribute is None:
+                if old["state"] != new["state"]:
+                    self._deliver(app, cb, (entity_id, "state", old["state"], new["state"], kwargs))
+            else:
+                o = old["attributes"].get(attribute)
+                n = new["attributes"].get(attribute)
+                if o != n:
+                    self._deliver(app, cb, (entity_id, attribute, o, n, kwargs))
+
+    # -- scheduling
+
+    def _push(self, at, item):
+        heapq.heappush(self._queue, (at, next(self._seq), item))
+
+    def _deliver(self, app, cb, args):
+        self._push(self.now, ("callback", app, cb, args))
+
+    def add_timer(self, app, at, cb, kwargs, interval=None, constrain_days=None):
+        handle = "timer-{}".format(next(self._handles))
+        self._timers[handle] = (app, cb, kwargs, interval, constrain_days)
+        self._push(at, ("timer", handle))
+        self.stats["timers_created"] += 1
+        self.max_live_timers = max(self.max_live_timers, len(self._timers))
+        return handle
+
+    def cancel_timer(self, handle):
+        if self._timers.pop(handle, None) is not None:
+            self.stats["timers_cancelled"] += 1
+
+    def live_timers(self):
+        return len(self._timers)
+
+    def listener_count(self):
+        return sum(len(v) for v in self._state_listeners.values()) + sum(len(v) for v in self._event_listeners.values())
+
+    def add_state_listener(self, app, cb, entity, attribute, kwargs):
+        handle = "state-{}".format(next(self._handles))
+        self._state_listeners.setdefault(entity, {})[handle] = (app, cb, entity, attribute, kwargs)
+        return handle
+
+    def add_event_listener(self, app, cb, event, kwargs):
+        handle = "event-{}".format(next(self._handles))
+        self._event_listeners.setdefault(event, {})[handle] = (app, cb, kwargs)
+        return handle
+
+    def fire_event(self, event, data):
+        for app, cb, kwargs in list(self._event_listeners.get(event, {}).values()):
+            self._deliver(app, cb, (event, data, kwargs))
+
+    def invoke(self, app, cb, args):
+        start = _time.perf_counter()
+        if asyncio.iscoroutinefunction(cb):
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(cb(*args))
+        else:
+            cb(*args)
+        self.latencies[callback_name(cb)].append(_time.perf_counter() - start)
+        self.stats["callbacks"] += 1
+
+    def run_until(self, until):
+        if until.tzinfo is None:
+            until = until.replace(tzinfo=self.now.tzinfo)
+        while len(self._queue) > 0 and self._queue[0][0] <= until:
+            at, _, item = heapq.heappop(self._queue)
+            self.now = max(self.now, at)
+            kind = item[0]
+            if kind == "callback":
+                self.invoke(item[1], item[2], item[3])
+            elif kind == "inject":
+                self._write_state(item[1], item[2], item[3])
+            elif kind == "timer":
+                self._fire_timer(item[1])
+        self.now = max(self.now, until)
+
+    def run_for(self, seconds):
+        self.run_until(self.now + datetime.timedelta(seconds=seconds))
+
+    def _fire_timer(self, handle):
+        entry = self._timers.get(handle)
+        if entry is None:
+            return
+        app, cb, kwargs, interval, constrain_days = entry
+        if interval is None:
+            del self._timers[handle]
+        else:
+            self._push(self.now + datetime.timedelta(seconds=interval), ("timer", handle))
+        if constrain_days is not None and WEEKDAYS[self.now.weekday()] not in constrain_days.split(","):
+            return
+        self.invoke(app, cb, (dict(kwargs),))
+
+    # -- reporting
+
+    def latency_summary(self):
+        res = {}
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            res[name] = {
+                "count": len(values),
+                "p50_us": percentile(values, 50) * 1e6,
+                "p95_us": percentile(values, 95) * 1e6,
+                "p99_us": percentile(values, 99) * 1e6,
+                "max_us": values[-1] * 1e6,
+            }
+        return res
+
+
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class Entity:
+    def __init__(self, hass, entity_id):
+        self.hass = hass
+        self.entity_id = entity_id
+
+    def exists(self):
+        return self.entity_id in self.hass._world.states
+
+    def get_state(self, attribute=None, default=None):
+        return self.hass.get_state(self.entity_id, attribute=attribute, default=default)
+
+    def listen_state(self, callback, **kwargs):
+        return self.hass.listen_state(callback, self.entity_id, **kwargs)
+
+    def set_state(self, **kwargs):
+        return self.hass.set_state(self.entity_id, **kwargs)
+
+
+class AppConfig:
+    # AppDaemon 4.5 keeps app configs as pydantic models: fields as attributes, `args` dumps the whole config
+    ALIASES = {"module_name": "module", "class_name": "class"}
+
+    def __init__(self, name, config):
+        self._config = dict(config, name=name)
+
+    def __getattr__(self, key):
+        key = self.ALIASES.get(key, key)
+        if key in self.ALIASES.values() or key not in self._config:
+            raise AttributeError("'AppConfig' object has no attribute '{}'".format(key))
+        return self._config[key]
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def args(self):
+        return dict(self._config)
+
+
+class AllAppConfig:
+    def __init__(self, config):
+        self.root = {k: AppConfig(k, v) for k, v in config.items()}
+
+    def __getitem__(self, key):
+        return self.root[key]
+
+
+class Hass:
+    def __init__(self, world, name, args=None):
+        self._world = world
+        self.name = name
+        self.args = args or {}
+        self.logger = logging.getLogger("fake_hass.{}".format(name))
+        self.logger.setLevel(world.log_level)
+        world.apps.append(self)
+
+    @property
+    def app_config(self):
+        return AllAppConfig(self._world.app_config)
+
+    # -- logging
+
+    def log(self, msg, *args, level="INFO", **kwargs):
+        self._world.log_levels[level] += 1
+        if self._world.echo_logs:
+            print("{} {} {}: {}".format(self._world.now.isoformat(), level, self.name, msg))
+
+    def error(self, msg, *args, level="ERROR", **kwargs):
+        self.log(msg, level=level)
+
+    # -- time
+
+    @api()
+    def get_now(self):
+        return self._world.now
+
+    @api()
+    def get_now_ts(self):
+        return self._world.now.timestamp()
+
+    def convert_utc(self, utc):
+        return datetime.datetime.fromisoformat(utc)
+
+    def parse_time(self, time_str, name=None, aware=False):
+        return datetime.time.fromisoformat(time_str)
+
+    @api()
+    def parse_datetime(self, time_str, name=None, aware=False):
+        t = self.parse_time(time_str)
+        return datetime.datetime.combine(self._world.now.date(), t, tzinfo=self._world.now.tzinfo)
+
+    def _aware(self, dt):
+        return dt.replace(tzinfo=self._world.now.tzinfo) if dt.tzinfo is None else dt
+
+    def _next_time_of_day(self, t):
+        if isinstance(t, str):
+            t = self.parse_time(t)
+        at = datetime.datetime.combine(self._world.now.date(), t, tzinfo=self._world.now.tzinfo)
+        if at < self._world.now:
+            at += datetime.timedelta(days=1)
+        return at
+
+    # -- states
+
+    def get_entity(self, entity_id):
+        return Entity(self, entity_id)
+
+    @api(io=True)
+    def get_state(self, entity_id=None, attribute=None, default=None, **kwargs):
+        self._world.stats["get_state"] += 1
+        states = self._world.states
+        if entity_id is None:
+            return {k: dict(v) for k, v in states.items()}
+        if "." not in entity_id:
+            return {k: dict(v) for k, v in states.items() if k.startswith(entity_id + ".")}
+        state = states.get(entity_id)
+        if state is None:
+            return default
+        if attribute == "all":
+            return dict(state)
+        if attribute is not None:
+            return state["attributes"].get(attribute, default)
+        return state["state"]
+
+    @api(io=True)
+    def set_state(self, entity_id, **kwargs):
+        self._world.stats["set_state"] += 1
+        state = kwargs.pop("state", None)
+        attributes = kwargs.pop("attributes", None)
+        replace = kwargs.pop("replace", False)
+        kwargs.pop("namespace", None)
+        if attributes is None:
+            attributes = kwargs
+        new = self._world._write_state(entity_id, state, attributes, replace=replace)
+        return dict(new)
+
+    @api()
+    def listen_state(self, callback, entity_id=None, attribute=None, **kwargs):
+        return self._world.add_state_listener(self, callback, entity_id, attribute, kwargs)
+
+    @api()
+    def listen_event(self, callback, event=None, **kwargs):
+        return self._world.add_event_listener(self, callback, event, kwargs)
+
+    @api()
+    def fire_event(self, event, **kwargs):
+        self._world.stats["fire_event"] += 1
+        self._world.fire_event(event, kwargs)
+
+    @api(io=True)
+    def call_service(self, service, **kwargs):
+        world = self._world
+        world.stats["call_service"] += 1
+        world.services[service] += 1
+        entity_id = kwargs.get("entity_id")
+        if service == "climate/set_temperature":
+            world._write_state(entity_id, None, {"temperature": kwargs["temperature"]})
+        elif service == "climate/turn_on":
+            world._write_state(entity_id, "heat", {})
+        elif service == "input_select/select_option":
+            world._write_state(entity_id, kwargs["option"], {})
+
+    @api(io=True)
+    def get_history(self, entity_id="", start_time=None, end_time=None, days=None, **kwargs):
+        world = self._world
+        world.stats["get_history"] += 1
+        if start_time is None:
+            start_time = world.now - datetime.timedelta(days=days or 1)
+        elif start_time.tzinfo is None:
+            # apps pass naive wall clock times, map them onto the virtual clock
+            start_time = world.now - (datetime.datetime.now() - start_time)
+        res = []
+        for e in entity_id.split(","):
+            rows = world.history.get(e.strip(), [])
+            before = [r for r in rows if datetime.datetime.fromisoformat(r["last_changed"]) < start_time]
+            rows = before[-1:] + [r for r in rows if datetime.datetime.fromisoformat(r["last_changed"]) >= start_time]
+            if len(rows) > 0:
+                res.append([dict(r) for r in rows])
+        return res
+
+    # -- scheduler
+
+    @api()
+    def run_in(self, callback, delay, **kwargs):
+        return self._world.add_timer(self, self._world.now + datetime.timedelta(seconds=delay), callback, kwargs)
+
+    @api()
+    def run_at(self, callback, start, **kwargs):
+        if isinstance(start, str):
+            start = self.parse_datetime(start)
+        start = self._aware(start)
+        if start < self._world.now:
+            start += datetime.timedelta(days=1)
+        return self._world.add_timer(self, start, callback, kwargs)
+
+    @api()
+    def run_once(self, callback, start, **kwargs):
+        return self._world.add_timer(self, self._next_time_of_day(start), callback, kwargs)
+
+    @api()
+    def run_daily(self, callback, start, **kwargs):
+        constrain_days = kwargs.pop("constrain_days", None)
+        return self._world.add_timer(self, self._next_time_of_day(start), callback, kwargs, interval=86400, constrain_days=constrain_days)
+
+    @api()
+    def run_every(self, callback, start, interval, **kwargs):
+        if start == "now":
+            start = self._world.now
+        elif isinstance(start, str) and start.startswith("now+"):
+            start = self._world.now + datetime.timedelta(seconds=int(start[4:]))
+        elif isinstance(start, str):
+            start = self.parse_datetime(start)
+        return self._world.add_timer(self, self._aware(start), callback, kwargs, interval=interval)
+
+    @api()
+    def cancel_timer(self, handle):
+        self._world.cancel_timer(handle)
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
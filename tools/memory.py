@@ -0,0 +1,106 @@
+"""Memory footprint of the SmartHeating domain objects.
+
+Builds a synthetic house with ``fake_hass`` and measures the bytes allocated by
+``SmartHeating.initialize`` with ``tracemalloc``, per room and per thermostat.
+The schedules are compiled separately so their share is reported on its own.
+
+    python tools/memory.py --rooms 1000 --thermostats 3 --schedules 50
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "apps"))
+
+import fake_hass
+
+fake_hass.install()
+
+import replay
+
+
+def house_config(rooms, thermostats, sensors, schedules, schedule_items):
+    args = replay.synthetic_config(rooms, thermostats, sensors, schedule_items)
+    main = args["schedules"]["schedule_main"]
+    # a few distinct schedules, each used by many rooms, plus duplicates under other names
+    for k in range(schedules):
+        args["schedules"]["schedule_{}".format(k)] = main[k % len(main):] + main[:k % len(main)]
+    for i, room in enumerate(args["rooms"].values()):
+        room["default_schedule"] = "schedule_{}".format(i % schedules) if schedules > 0 else "schedule_main"
+    return args
+
+
+def measure(opts):
+    args = house_config(opts.rooms, opts.thermostats, opts.sensors, opts.schedules, opts.schedule_items)
+    tmp = tempfile.mkdtemp(prefix="memory")
+    args["snapshot_path"] = os.path.join(tmp, "snapshot.json")
+    args["history_path"] = os.path.join(tmp, "history.gz")
+    args["house_controller"] = False
+    world = fake_hass.World(replay.DEFAULT_START)
+    replay.populate_world(world, args, random.Random(opts.seed))
+
+    import smart_heating
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    schedules = smart_heating.shared_schedules(args["schedules"])
+    gc.collect()
+    after_schedules = tracemalloc.take_snapshot()
+
+    app = smart_heating.SmartHeating(world, "smart_heating", args)
+    world.invoke(app, app.initialize, ())
+    gc.collect()
+    after_rooms = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    def size(a, b):
+        return sum(s.size_diff for s in b.compare_to(a, "filename"))
+
+    apps_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "apps")
+    rooms_bytes = size(after_schedules, after_rooms)
+    schedule_bytes = size(before, after_schedules)
+    # allocations made by the app code only, without the fake world's listeners and timers
+    app_filter = [tracemalloc.Filter(True, os.path.join(apps_dir, "*"))]
+    app_rooms_bytes = size(after_schedules.filter_traces(app_filter), after_rooms.filter_traces(app_filter))
+    thermostats = opts.rooms * opts.thermostats
+    return {
+        "rooms": opts.rooms,
+        "thermostats": thermostats,
+        "schedules": len(schedules),
+        "schedule_bytes": schedule_bytes,
+        "bytes_per_schedule": schedule_bytes / max(1, len(schedules)),
+        "rooms_bytes": rooms_bytes,
+        "bytes_per_room": rooms_bytes / opts.rooms,
+        "app_bytes_per_room": app_rooms_bytes / opts.rooms,
+        "app_bytes_per_thermostat": app_rooms_bytes / thermostats,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=500)
+    parser.add_argument("--thermostats", type=int, default=3, help="thermostats per room")
+    parser.add_argument("--sensors", type=int, default=1, help="temperature sensors per room")
+    parser.add_argument("--schedules", type=int, default=20, help="distinct schedules shared by the rooms")
+    parser.add_argument("--schedule-items", type=int, default=28)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    opts = parser.parse_args(argv)
+
+    res = measure(opts)
+    if opts.json:
+        print(json.dumps(res, indent=2, sort_keys=True))
+    else:
+        for k, v in res.items():
+            print("{:26s} {}".format(k, round(v, 1) if isinstance(v, float) else v))
+
+
+if __name__ == "__main__":
+    main()
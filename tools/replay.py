@@ -0,0 +1,256 @@
+"""Offline replay and benchmark runner for the SmartHeating app.
+
+Runs ``apps/smart_heating.py`` against ``fake_hass`` with a virtual clock, feeds
+it a synthetic or recorded stream of sensor and thermostat states and reports
+throughput, callback latency percentiles, service calls and scheduler handles.
+
+    python tools/replay.py --rooms 20 --thermostats 3 --schedule-items 28 --hours 24
+    python tools/replay.py --config apps/apps.yaml --app smart_heating --recording stream.jsonl
+    python tools/replay.py --module smart_heating_async --app-class SmartHeatingAsync --io-latency-ms 5
+
+Recordings are JSON lines ``{"time": <seconds from start or ISO datetime>,
+"entity_id": ..., "state": ..., "attributes": {...}}``.
+"""
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "apps"))
+
+import fake_hass
+
+fake_hass.install()
+
+DEFAULT_START = datetime.datetime(2024, 1, 8, 0, 0, tzinfo=datetime.timezone.utc)  # a Monday
+
+
+def synthetic_schedule(items):
+    # `items` non overlapping items spread evenly over the week
+    per_day = max(1, math.ceil(items / 7))
+    slot = 1440 // (2 * per_day + 1)
+    res = []
+    for k in range(items):
+        weekday, j = k % 7 + 1, k // 7
+        start, end = (2 * j + 1) * slot, (2 * j + 2) * slot
+        res.append({
+            "start": "{:02d}:{:02d}".format(start // 60, start % 60),
+            "end": "{:02d}:{:02d}".format(end // 60, end % 60),
+            "weekdays": str(weekday),
+            "setmode": "comfort",
+        })
+    return res
+
+
+def synthetic_config(rooms, thermostats, sensors, schedule_items):
+    args = {
+        "default_modes": {"comfort": 21, "eco": 18},
+        "schedules": {
+            "schedule_main": synthetic_schedule(schedule_items),
+            "schedule_away": [{"start": "00:00", "end": "23:59", "setmode": "eco"}],
+        },
+        "rooms": {},
+    }
+    for r in range(rooms):
+        args["rooms"]["room{}".format(r)] = {
+            "control": "climate.room{}".format(r),
+            "thermostats": [{"entity_id": "climate.room{}_trv{}".format(r, t), "alpha": 1.0, "offset": 0} for t in range(thermostats)],
+            "temperature_sensors": ["sensor.room{}_temperature{}".format(r, s) for s in range(sensors)],
+            "default_schedule": "schedule_main",
+            "conditional_schedules": [{
+                "type": "input_select",
+                "entity_id": "input_select.heating_control",
+                "values": {"family_away": "schedule_away"},
+            }],
+        }
+    return args
+
+
+def populate_world(world, args, rng):
+    world.add_entity("input_select.heating_control", "automatic")
+    for room in args["rooms"].values():
+        for c in room.get("conditional_schedules") or []:
+            if c["entity_id"] not in world.states:
+                world.add_entity(c["entity_id"], "automatic")
+        world.add_entity(room["control"], "heat", {"temperature": 18, "current_temperature": 19})
+        for t in room["thermostats"]:
+            world.add_entity(t["entity_id"], "heat", {"temperature": 18, "current_temperature": round(rng.uniform(18, 21), 1)})
+        for s in room["temperature_sensors"]:
+            world.add_entity(s, str(round(rng.uniform(18, 21), 1)))
+
+
+def synthetic_stream(world, args, start, hours, sensor_rate, rng):
+    # poisson arrivals, `sensor_rate` readings per sensor and hour, thermostats report at half the rate
+    end = start + datetime.timedelta(hours=hours)
+    sources = []
+    for room in args["rooms"].values():
+        sources.extend((s, None, sensor_rate) for s in room["temperature_sensors"])
+        sources.extend((t["entity_id"], "current_temperature", sensor_rate / 2.0) for t in room["thermostats"])
+
+    for entity_id, attribute, rate in sources:
+        if rate <= 0:
+            continue
+        value = float(world.states[entity_id]["attributes"][attribute] if attribute else world.states[entity_id]["state"])
+        at = start
+        while True:
+            at += datetime.timedelta(seconds=rng.expovariate(rate / 3600.0))
+            if at >= end:
+                break
+            value = round(min(24.0, max(15.0, value + rng.gauss(0, 0.15))), 1)
+            if attribute is None:
+                world.inject(at, entity_id, state=str(value))
+            else:
+                world.inject(at, entity_id, attributes={attribute: value})
+
+
+def recorded_stream(world, path, start):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            t = rec["time"]
+            if isinstance(t, (int, float)):
+                at = start + datetime.timedelta(seconds=t)
+            else:
+                at = datetime.datetime.fromisoformat(t)
+                if at.tzinfo is None:
+                    at = at.replace(tzinfo=start.tzinfo)
+            world.inject(at, rec["entity_id"], state=rec.get("state"), attributes=rec.get("attributes"))
+
+
+def load_app_config(path):
+    import yaml
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+def load_app_args(path, app):
+    return load_app_config(path)[app]
+
+
+def resolve_rooms(args, app_config):
+    # shards name their rooms and take the room config from the app given as `config`
+    if "config" in args:
+        return {"rooms": {k: app_config[args["config"]]["rooms"][k] for k in args["rooms"]}}
+    return args
+
+
+def run(opts):
+    rng = random.Random(opts.seed)
+    app_config = {}
+    if opts.config:
+        app_config = load_app_config(opts.config)
+        args = app_config[opts.app]
+    else:
+        args = synthetic_config(opts.rooms, opts.thermostats, opts.sensors, opts.schedule_items)
+    args.update(json.loads(opts.set_args))
+    # runs must not warm start from each other
+    tmp = tempfile.mkdtemp(prefix="replay")
+    args.setdefault("snapshot_path", os.path.join(tmp, "snapshot.json"))
+    args.setdefault("history_path", os.path.join(tmp, "history.gz"))
+
+    world = fake_hass.World(DEFAULT_START)
+    world.app_config = app_config
+    world.io_latency = opts.io_latency_ms / 1000.0
+    world.echo_logs = opts.verbose
+    world.log_level = logging.DEBUG if opts.verbose else logging.INFO
+    rooms = resolve_rooms(args, app_config)
+    populate_world(world, rooms, rng)
+
+    module = importlib.import_module(opts.module)
+    app_class = getattr(module, opts.app_class)
+
+    wall_start = time.perf_counter()
+    app = app_class(world, opts.app, args)
+    world.invoke(app, app.initialize, ())
+    world.run_for(0)
+    init_seconds = time.perf_counter() - wall_start
+    init_stats = dict(world.stats)
+
+    if opts.recording:
+        recorded_stream(world, opts.recording, world.now)
+    else:
+        synthetic_stream(world, rooms, world.now, opts.hours, opts.sensor_rate, rng)
+
+    run_start = time.perf_counter()
+    world.run_until(DEFAULT_START + datetime.timedelta(hours=opts.hours))
+    run_seconds = time.perf_counter() - run_start
+
+    return {
+        "rooms": len(rooms["rooms"]),
+        "thermostats": sum(len(r["thermostats"]) for r in rooms["rooms"].values()),
+        "simulated_hours": opts.hours,
+        "init_seconds": init_seconds,
+        "init_get_state": init_stats.get("get_state", 0),
+        "run_seconds": run_seconds,
+        "events_injected": world.stats["injected"],
+        "events_per_second": world.stats["injected"] / run_seconds if run_seconds > 0 else None,
+        "callbacks": world.stats["callbacks"],
+        "get_state": world.stats["get_state"],
+        "set_state": world.stats["set_state"],
+        "call_service": world.stats["call_service"],
+        "services": dict(world.services),
+        "timers_created": world.stats["timers_created"],
+        "timers_live": world.live_timers(),
+        "timers_max_live": world.max_live_timers,
+        "listeners": world.listener_count(),
+        "latency": world.latency_summary(),
+        "app_counters": app.metrics.summary()["counters"] if hasattr(app, "metrics") else {},
+    }
+
+
+def print_report(res):
+    for k, v in res.items():
+        if k in ("latency", "services", "app_counters"):
+            continue
+        print("{:20s} {}".format(k, round(v, 4) if isinstance(v, float) else v))
+    print("app counters")
+    for k, v in sorted(res["app_counters"].items()):
+        print("  {:40s} {}".format(k, v))
+    print("services")
+    for k, v in sorted(res["services"].items()):
+        print("  {:40s} {}".format(k, v))
+    print("callback latency (us)       count      p50      p95      p99      max")
+    for name, l in sorted(res["latency"].items(), key=lambda x: -x[1]["count"]):
+        print("  {:26s} {:7d} {:8.1f} {:8.1f} {:8.1f} {:8.1f}".format(name[-26:], l["count"], l["p50_us"], l["p95_us"], l["p99_us"], l["max_us"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", help="apps.yaml to take the app arguments from instead of a synthetic house")
+    parser.add_argument("--app", default="smart_heating", help="app name in the config")
+    parser.add_argument("--module", default="smart_heating", help="module in apps/ holding the app class")
+    parser.add_argument("--app-class", default="SmartHeating")
+    parser.add_argument("--io-latency-ms", type=float, default=0.0, help="wall clock delay per Home Assistant round trip")
+    parser.add_argument("--set-args", default="{}", help="JSON object merged into the app arguments")
+    parser.add_argument("--recording", help="JSON lines state stream to replay instead of synthetic readings")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--thermostats", type=int, default=2, help="thermostats per room")
+    parser.add_argument("--sensors", type=int, default=1, help="temperature sensors per room")
+    parser.add_argument("--schedule-items", type=int, default=14)
+    parser.add_argument("--sensor-rate", type=float, default=30.0, help="readings per sensor and hour")
+    parser.add_argument("--hours", type=float, default=24.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="echo app logs")
+    opts = parser.parse_args(argv)
+
+    res = run(opts)
+    if opts.json:
+        print(json.dumps(res, indent=2, sort_keys=True))
+    else:
+        print_report(res)
+
+
+if __name__ == "__main__":
+    main()